@@ -1,19 +1,33 @@
 # admin.py
 from __future__ import annotations
 
-from datetime import datetime, timedelta
+import asyncio
+import logging
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 from aiogram import Bot, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import CommandObject
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-import db as booking_db
+import db_async as booking_db
+import export as export_mod
+import metrics
+import outbox
+import reminders
+from occupancy import INDEX as OCCUPANCY, local_today
 from config import SETTINGS, get_admin_ids, QUESTS
-from booking_logic import calc_price
+from booking_logic import calc_price, parse_slot_iso
+from notify import notify_admins
 from texts import quest_info_text, ADULT_RULES, KIDS_RULES, FINAL_WISH
 
 
+log = logging.getLogger(__name__)
+
 ADMIN_IDS = set(get_admin_ids())
 TZ = ZoneInfo(SETTINGS.TZ)
 
@@ -38,8 +52,12 @@ def rules_ack_kb(booking_id: int):
 
 
 def admin_dates_kb():
+    return _admin_dates_kb_for(datetime.now(TZ).date())
+
+
+@lru_cache(maxsize=2)
+def _admin_dates_kb_for(today: date):
     kb = InlineKeyboardBuilder()
-    today = datetime.now(TZ).date()
     for i in range(0, SETTINGS.DAYS_AHEAD + 1):
         d = today + timedelta(days=i)
         kb.button(text=d.strftime("%d.%m"), callback_data=f"admin_date:{d.isoformat()}")
@@ -57,81 +75,249 @@ async def cmd_admin(message: Message):
     await message.answer("Выберите дату для просмотра броней:", reply_markup=admin_dates_kb())
 
 
-async def admin_choose_date(call: CallbackQuery):
-    if not is_admin(call.from_user.id):
-        await call.answer()
+async def cmd_check_occupancy(message: Message):
+    # сверка индекса занятости в памяти с БД
+    if not is_admin(message.from_user.id):
+        return
+    diff = await booking_db.run(OCCUPANCY.verify)
+    if not diff:
+        await message.answer("Индекс занятости совпадает с базой ✅")
         return
+    lines = [f"Расхождений: {len(diff)} (перезагружаю индекс)"]
+    for slot_iso, mem, actual in diff[:20]:
+        lines.append(f"{slot_iso}: память={sorted(mem)} база={sorted(actual)}")
+    await booking_db.run(OCCUPANCY.load, local_today())
+    await message.answer("\n".join(lines))
 
-    await call.answer()
-    d_iso = (call.data or "").split("admin_date:", 1)[-1]
 
-    rows = booking_db.list_bookings_for_date(d_iso)
-    if not rows:
-        await call.message.answer(f"На {d_iso} броней нет.")
+async def cmd_outbox(message: Message):
+    if not is_admin(message.from_user.id):
         return
+    st = await outbox.stats()
+    lines = [
+        "Очередь исходящих:",
+        f"• в очереди: {st['pending']}",
+        f"• ожидает дольше всех: {st['oldest_due_age']:.0f} с",
+        f"• не доставлено (dead): {st['dead']}",
+    ]
+    for oid, chat_id, attempts, err in st["recent_dead"]:
+        lines.append(f"#{oid} → {chat_id}, попыток {attempts}: {(err or '-')[:200]}")
+    rs = await reminders.stats()
+    lines.append(f"Напоминания: ждут {rs['pending']}, отправлено {rs['sent']}, пропущено {rs['skipped']}")
+    await message.answer("\n".join(lines))
+
+
+# ---------- просмотр броней по страницам ----------
+PAGE_SIZE = 10
+
+# код в callback_data -> статус в БД (None — все)
+STATUS_FILTERS = {"a": None, "p": "pending", "c": "confirmed", "r": "rejected", "x": "expired"}
+STATUS_TITLES = {"a": "все", "p": "ожидают", "c": "подтверждены", "r": "отклонены", "x": "истекли"}
+QUEST_FILTERS = ("*", *QUESTS)
+
+
+def _next_in(seq, current):
+    return seq[(seq.index(current) + 1) % len(seq)]
 
-    lines = [f"Брони на {d_iso}:\n"]
+
+def page_cb(d_iso: str, st: str, q: str, direction: str, cursor: tuple[str, int] | None = None) -> str:
+    # ap:<дата>:<статус>:<квест>:<f|n|p>:<HHMM>:<id> — укладывается в 64 байта callback_data
+    hhmm, bid = (cursor[0][11:16].replace(":", ""), cursor[1]) if cursor else ("-", 0)
+    return f"ap:{d_iso}:{st}:{q}:{direction}:{hhmm}:{bid}"
+
+
+def format_booking_rows(rows):
     for (bid, title, team, name, phone, slot_iso, status, confirmed_by) in rows:
         t = slot_iso.split("T")[1]
         conf = confirmed_by or "-"
-        lines.append(f"#{bid} | {t} | {title} | {team} чел | {status} | подтвердил: {conf} | {name} | {phone}")
+        yield f"#{bid} | {t} | {title} | {team} чел | {status} | подтвердил: {conf} | {name} | {phone}"
+
 
-    text = "\n".join(lines)
-    for i in range(0, len(text), 3500):
-        await call.message.answer(text[i:i+3500])
+async def render_bookings_page(d_iso: str, st: str, q: str, direction: str,
+                               cursor: tuple[str, int] | None):
+    backward = direction == "p"
+    rows = await booking_db.list_bookings_page(
+        d_iso, cursor=cursor if direction != "f" else None, backward=backward,
+        status=STATUS_FILTERS[st], service_key=None if q == "*" else q, limit=PAGE_SIZE + 1,
+    )
+    # лишняя строка — признак, что в эту сторону есть ещё страница
+    more = len(rows) > PAGE_SIZE
+    if more:
+        rows = rows[1:] if backward else rows[:PAGE_SIZE]
+    has_prev = more if backward else direction == "n"
+    has_next = more if not backward else True
 
+    quest_title = "все" if q == "*" else QUESTS[q]["title"]
+    header = f"Брони на {d_iso} (статус: {STATUS_TITLES[st]}, квест: {quest_title}):\n"
+    body = "\n".join(format_booking_rows(rows)) or "Броней нет."
 
-async def admin_confirm(call: CallbackQuery, bot: Bot):
+    kb = InlineKeyboardBuilder()
+    nav = 0
+    if rows and has_prev:
+        first = rows[0]
+        kb.button(text="◀️", callback_data=page_cb(d_iso, st, q, "p", (first[5], first[0])))
+        nav += 1
+    if rows and has_next:
+        last = rows[-1]
+        kb.button(text="▶️", callback_data=page_cb(d_iso, st, q, "n", (last[5], last[0])))
+        nav += 1
+    kb.button(text=f"Статус: {STATUS_TITLES[st]}", callback_data=page_cb(d_iso, _next_in(tuple(STATUS_FILTERS), st), q, "f"))
+    kb.button(text=f"Квест: {quest_title}", callback_data=page_cb(d_iso, st, _next_in(QUEST_FILTERS, q), "f"))
+    kb.adjust(*([nav] if nav else []), 2)
+    return header + "\n" + body, kb.as_markup()
+
+
+EXPORT_USAGE = (
+    "Выгрузка броней:\n"
+    "/export 2026 — за год\n"
+    "/export 2026-01 — за месяц\n"
+    "/export 2026-01-01 2026-03-31 — за период\n"
+    "Добавьте xlsx в конце для Excel (по умолчанию csv.gz)."
+)
+TELEGRAM_FILE_LIMIT = 50 * 1024 * 1024
+
+
+# чаты, для которых выгрузка уже идёт (повторная доставка /export не запустит вторую)
+_EXPORTS_RUNNING: set[int] = set()
+_export_tasks: set[asyncio.Task] = set()
+
+
+async def cmd_export(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        return
+
+    args = (command.args or "").split()
+    fmt = "csv"
+    if args and args[-1].lower() in ("csv", "xlsx"):
+        fmt = args.pop().lower()
+    try:
+        start, end = export_mod.parse_period(args)
+    except ValueError:
+        await message.answer(EXPORT_USAGE)
+        return
+    if fmt == "xlsx" and not export_mod.xlsx_available():
+        await message.answer("XLSX недоступен (не установлен openpyxl), выгружаю csv.gz.")
+        fmt = "csv"
+    if message.chat.id in _EXPORTS_RUNNING:
+        await message.answer("Выгрузка уже готовится, пришлю файл, как только закончу.")
+        return
+
+    # отвечаем сразу, файл пришлём из фоновой задачи: за время выгрузки
+    # Telegram не дождался бы ответа на вебхук и прислал бы /export повторно
+    _EXPORTS_RUNNING.add(message.chat.id)
+    task = asyncio.create_task(_run_export(message, fmt, start, end))
+    _export_tasks.add(task)
+    task.add_done_callback(_export_tasks.discard)
+    await message.answer("Готовлю выгрузку, пришлю файл, когда будет готов.")
+
+
+async def _run_export(message: Message, fmt: str, start: date, end: date):
+    suffix = ".xlsx" if fmt == "xlsx" else ".csv.gz"
+    writer = export_mod.write_xlsx if fmt == "xlsx" else export_mod.write_csv_gz
+    last = end - timedelta(days=1)
+    filename = f"bookings_{start.isoformat()}_{last.isoformat()}{suffix}"
+
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        # свой поток и своё соединение: пул db_async (DB_WORKERS потоков) не занимаем
+        n = await asyncio.to_thread(writer, start, end, path)
+        if os.path.getsize(path) > TELEGRAM_FILE_LIMIT:
+            await message.answer("Файл больше 50 МБ — выберите период поменьше.")
+            return
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"Броней: {n}")
+    except Exception:
+        log.exception("export %s..%s failed", start, end)
+        await message.answer("Не удалось сделать выгрузку, попробуйте ещё раз позже.")
+    finally:
+        _EXPORTS_RUNNING.discard(message.chat.id)
+        os.remove(path)
+
+
+async def admin_choose_date(call: CallbackQuery):
     if not is_admin(call.from_user.id):
         await call.answer()
         return
 
     await call.answer()
-    booking_id = int((call.data or "").split(":")[-1])
-    admin_name = admin_display_name(call.from_user)
+    d_iso = (call.data or "").split("admin_date:", 1)[-1]
 
-    changed = booking_db.confirm_booking(booking_id, call.from_user.id, admin_name)
-    if changed == 0:
-        await call.message.answer("Эта бронь уже обработана.")
+    text, markup = await render_bookings_page(d_iso, "a", "*", "f", None)
+    await call.message.answer(text, reply_markup=markup)
+
+
+async def admin_bookings_page(call: CallbackQuery):
+    if not is_admin(call.from_user.id):
+        await call.answer()
         return
 
-    row = booking_db.get_booking(booking_id)
-    if not row:
-        await call.message.answer("Не нашёл бронь в базе.")
+    await call.answer()
+    try:
+        _, d_iso, st, q, direction, hhmm, bid = (call.data or "").split(":")
+        if st not in STATUS_FILTERS or q not in QUEST_FILTERS or direction not in ("f", "n", "p"):
+            return
+        cursor = (f"{d_iso}T{hhmm[:2]}:{hhmm[2:]}", int(bid)) if direction != "f" else None
+    except ValueError:
         return
 
-    (_id, tg_user_id, tg_username, client_name, phone, service_key, service_title,
-     team_size, slot_iso, status, c_by_id, c_by_name, c_at) = row
+    text, markup = await render_bookings_page(d_iso, st, q, direction, cursor)
+    await call.message.edit_text(text, reply_markup=markup)
+
 
-    slot_dt = datetime.strptime(slot_iso, "%Y-%m-%dT%H:%M").replace(tzinfo=TZ)
+def confirmation_messages(row) -> list[tuple[str, str | None]]:
+    """Сообщения гостю при подтверждении; строятся в транзакции confirm_booking."""
+    booking_id, _uid, service_key, service_title, team_size, slot_iso = row
+    slot_dt = parse_slot_iso(slot_iso)
     slot_str = slot_dt.strftime("%d.%m.%Y %H:%M")
 
     price = calc_price(service_key, team_size, slot_dt)
 
     # 1) сообщение подтверждения
-    await bot.send_message(
-        tg_user_id,
+    messages: list = [
         f"Ждем вас {slot_str} на квесте «{service_title}».\n"
         f"Цена за {team_size} человек будет {price} рублей.\n"
         f"{SETTINGS.PAYMENT}\n"
         f"Находимся мы по адресу {SETTINGS.ADDRESS}"
-    )
+    ]
 
     # 2) доп сообщение только для взрослых квестов (inferno/patient0/cannibal)
     if QUESTS[service_key]["has_info"]:
-        await bot.send_message(tg_user_id, quest_info_text(service_key))
+        messages.append(quest_info_text(service_key))
         # 3) правила + кнопка
-        await bot.send_message(tg_user_id, ADULT_RULES, reply_markup=rules_ack_kb(booking_id))
+        messages.append((ADULT_RULES, rules_ack_kb(booking_id)))
     else:
         # детские: сразу правила (внутри текста уже есть пожелание)
-        await bot.send_message(tg_user_id, KIDS_RULES)
+        messages.append(KIDS_RULES)
+    return outbox.pack(*messages)
+
+
+def rejection_text(row) -> str:
+    return "К сожалению, время недоступно. Создайте бронь заново: /start"
+
+
+async def admin_confirm(call: CallbackQuery, bot: Bot):
+    if not is_admin(call.from_user.id):
+        await call.answer()
+        return
+
+    await call.answer()
+    booking_id = int((call.data or "").split(":")[-1])
+    admin_name = admin_display_name(call.from_user)
+
+    # смена статуса, напоминания и сообщения гостю — одна транзакция;
+    # отправит фоновый воркер outbox, с повторами и в исходном порядке
+    changed = await booking_db.confirm_booking(booking_id, call.from_user.id, admin_name,
+                                               reminders.plan, confirmation_messages)
+    if changed == 0:
+        await call.message.answer("Эта бронь уже обработана.")
+        return
+    outbox.wake()
+
+    row = await booking_db.get_booking(booking_id)
+    metrics.BOOKINGS.inc("confirmed", row[5] if row else "")
 
     # уведомление админам кто подтвердил
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, f"✅ Бронь #{booking_id} подтверждена.\nПодтвердил: {admin_name}")
-        except Exception:
-            pass
+    await notify_admins(bot, ADMIN_IDS, f"✅ Бронь #{booking_id} подтверждена.\nПодтвердил: {admin_name}")
 
     await call.message.answer(f"Подтверждено: #{booking_id}")
 
@@ -145,21 +331,16 @@ async def admin_reject(call: CallbackQuery, bot: Bot):
     booking_id = int((call.data or "").split(":")[-1])
     admin_name = admin_display_name(call.from_user)
 
-    changed = booking_db.reject_booking(booking_id)
+    changed = await booking_db.reject_booking(booking_id, rejection_text)
     if changed == 0:
         await call.message.answer("Эта бронь уже обработана.")
         return
+    outbox.wake()
 
-    row = booking_db.get_booking(booking_id)
-    if row:
-        tg_user_id = row[1]
-        await bot.send_message(tg_user_id, "К сожалению, время недоступно. Создайте бронь заново: /start")
+    row = await booking_db.get_booking(booking_id)
+    metrics.BOOKINGS.inc("rejected", row[5] if row else "")
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, f"❌ Бронь #{booking_id} отклонена.\nОтклонил: {admin_name}")
-        except Exception:
-            pass
+    await notify_admins(bot, ADMIN_IDS, f"❌ Бронь #{booking_id} отклонена.\nОтклонил: {admin_name}")
 
     await call.message.answer(f"Отклонено: #{booking_id}")
 
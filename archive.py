@@ -0,0 +1,61 @@
+# archive.py
+"""
+Перенос прошедших броней в bookings_archive.
+
+Основная таблица остаётся маленькой: в ней только сегодняшние и будущие брони
+(плюс ARCHIVE_KEEP_DAYS прошедших дней), их и читают проверки слотов и админка.
+Перенос идёт пачками по ARCHIVE_BATCH строк в отдельных коротких транзакциях
+с паузой между ними, чтобы не задерживать брони. История (выгрузка, выборки
+с include_archive=True) читает обе таблицы.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from datetime import date, timedelta
+
+import db
+import db_async as booking_db
+from occupancy import local_today
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_KEEP_DAYS = int(os.getenv("ARCHIVE_KEEP_DAYS", "1"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_PAUSE = 0.05
+ARCHIVE_INTERVAL = 6 * 3600.0
+
+
+def cutoff(today: date) -> str:
+    # всё, что раньше начала этого дня, уходит в архив
+    return (today - timedelta(days=ARCHIVE_KEEP_DAYS)).isoformat()
+
+
+async def archive_once(today: date | None = None) -> int:
+    before = cutoff(today or local_today())
+    total = 0
+    while True:
+        n = await booking_db.run(db.archive_past_bookings, before, ARCHIVE_BATCH)
+        if not n:
+            break
+        total += n
+        await asyncio.sleep(ARCHIVE_PAUSE)
+    if total:
+        log.info("archived %s bookings before %s", total, before)
+    return total
+
+
+async def archive_loop():
+    while True:
+        try:
+            await archive_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("archive run failed")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+async def stats() -> dict:
+    return await booking_db.run(db.archive_stats)
@@ -0,0 +1,1165 @@
+# bench.py
+"""
+Бенчмарки слоя БД на временной базе.
+
+    python bench.py pool [--ops N]
+    python bench.py loop   (event loop не блокируется медленным запросом через db_async)
+    python bench.py indexes [--rows N]
+    python bench.py reserve [--ops N] [--threads N]
+    python bench.py slots [--ops N]
+    python bench.py fsm [--ops N]
+    python bench.py export [--rows N]   (по умолчанию 1 000 000 строк)
+    python bench.py archive [--rows N]
+    python bench.py metrics [--ops N]
+    python bench.py notify   (рассылка через подставную сессию Bot API: ошибки и лимиты)
+    python bench.py outbox   (чат с отложенным первым сообщением не крутит воркер вхолостую)
+    python bench.py rules [--ops N]
+    python bench.py firstfree [--days N] [--ops N]   (ближайшие свободные и счётчики по датам)
+    python bench.py expiry [--rows N]   (истечение pending на подставных часах)
+    python bench.py reminders [--ops N]   (N подтверждённых броней, подставные часы и перезапуск)
+    python bench.py startup [--repeat N] [--save FILE] [--compare FILE] [--threshold 0.2]
+    python bench.py suite [--rows N] [--days N] [--seed N] [--ops N] [--repeat N]
+                          [--save FILE] [--compare FILE] [--threshold 0.2]
+
+suite — основные функции booking_logic и db на синтетической базе; startup —
+холодный старт (импорт bot/web в отдельном процессе и инициализация). С --compare
+сравнивает с сохранённым через --save результатом и завершается с кодом 1,
+если что-то стало медленнее больше чем на threshold (доля).
+"""
+import argparse
+import asyncio
+import json
+import os
+import itertools
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import db
+from booking_logic import (
+    calc_price, free_slots_in_snapshot, generate_slots_for_date, slot_accepts, slot_allowed_by_time,
+    slot_available_for_service, slots_for_date,
+)
+from config import QUESTS, SETTINGS
+from rules import RULES, SERVICE_BITS
+
+
+def _seed_db(path: str):
+    db.DB_PATH = path
+    db.init_db()
+
+
+def seed_bookings(rows: int, days: int, start: date = date(2020, 1, 1), seed: int = 1) -> list[str]:
+    """Заливает rows синтетических броней на days дней начиная со start; возвращает даты."""
+    rnd = random.Random(seed)
+    dates = [start + timedelta(days=i) for i in range(days)]
+    slots = [dt.strftime("%Y-%m-%dT%H:%M") for dt in generate_slots_for_date(start)]
+    times = [s.split("T")[1] for s in slots]
+    keys = list(QUESTS)
+    statuses = ("pending", "confirmed", "confirmed", "rejected")
+
+    # активные брони раскладываем по правилам (rules.RULES), остальные — отклонённые,
+    # иначе их не пропустит триггер ёмкости слота
+    free = {hhmm: RULES.table(datetime.strptime(hhmm, "%H:%M").time()) for hhmm in times}
+    active: dict[str, int] = {}
+
+    def gen():
+        for i in range(rows):
+            d = dates[i % days].isoformat()
+            key = rnd.choice(keys)
+            hhmm = rnd.choice(times)
+            slot_iso = f"{d}T{hhmm}"
+            status = rnd.choice(statuses)
+            if status != "rejected":
+                taken = active.get(slot_iso, 0)
+                if free[hhmm][taken] & SERVICE_BITS[key]:
+                    active[slot_iso] = taken | SERVICE_BITS[key]
+                else:
+                    status = "rejected"
+            yield (
+                "2020-01-01T00:00:00", rnd.randint(1, rows // 3 + 1), None, "Bench", "+79990000000",
+                key, QUESTS[key]["title"], 4, slot_iso, status,
+            )
+
+    with db.connection() as con:
+        con.executemany("""
+            INSERT INTO bookings (created_at, tg_user_id, tg_username, name, phone,
+                                  service_key, service_title, team_size, slot_iso, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, gen())
+        con.commit()
+    return [d.isoformat() for d in dates]
+
+
+def query_plan(sql: str, params: tuple) -> str:
+    with db.connection() as con:
+        rows = con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return " | ".join(r[-1] for r in rows)
+
+
+def _connect_per_call_list(slot_iso: str) -> set[str]:
+    # старый путь: новое соединение на каждый запрос
+    con = sqlite3.connect(db.DB_PATH)
+    cur = con.cursor()
+    cur.execute("""
+        SELECT service_key
+        FROM bookings
+        WHERE slot_iso=? AND status IN ('pending','confirmed')
+    """, (slot_iso,))
+    rows = cur.fetchall()
+    con.close()
+    return {r[0] for r in rows}
+
+
+def _ops_per_sec(fn, ops: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return ops / (time.perf_counter() - t0)
+
+
+def bench_pool(ops: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        slot = "2030-01-01T10:00"
+        res = {
+            "connect_per_call_ops": _ops_per_sec(lambda i: _connect_per_call_list(slot), ops),
+            "pooled_ops": _ops_per_sec(lambda i: db.list_slot_services(slot), ops),
+        }
+        db.close_pool()
+    res["speedup"] = res["pooled_ops"] / res["connect_per_call_ops"]
+    return res
+
+
+def _slow_query(n: int = 3_000_000) -> int:
+    # заведомо медленный запрос; sqlite3 отпускает GIL, пока выполняется шаг
+    with db.connection() as con:
+        return con.execute("""
+            WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < ?)
+            SELECT COUNT(*) FROM c
+        """, (n,)).fetchone()[0]
+
+
+def bench_loop(tick: float = 0.01, max_lag: float = 0.1) -> dict:
+    """
+    Медленный вызов db через db_async.run рядом с тикером asyncio.sleep(tick):
+    запаздывание тикера должно оставаться меньше max_lag. Для сравнения —
+    тот же вызов прямо в event loop.
+    """
+    import db_async
+
+    async def measure(call) -> tuple[float, float]:
+        lags = []
+        done = False
+
+        async def ticker():
+            while not done:
+                t = time.perf_counter()
+                await asyncio.sleep(tick)
+                lags.append(time.perf_counter() - t - tick)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(tick * 3)
+        t0 = time.perf_counter()
+        await call()
+        elapsed = time.perf_counter() - t0
+        done = True
+        await task
+        return elapsed, max(lags)
+
+    async def blocking():
+        _slow_query()
+
+    async def run():
+        return {
+            "executor": await measure(lambda: db_async.run(_slow_query)),
+            "inline": await measure(blocking),
+        }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        res = asyncio.run(run())
+        db_async.shutdown()
+    (slow, lag), (inline_slow, inline_lag) = res["executor"], res["inline"]
+    assert slow > max_lag * 2, f"запрос слишком быстрый для проверки: {slow:.3f} с"
+    assert lag < max_lag, f"event loop stalled for {lag * 1000:.0f} ms"
+    return {"query_ms": slow * 1000, "max_tick_lag_ms": lag * 1000,
+            "inline_query_ms": inline_slow * 1000, "inline_max_tick_lag_ms": inline_lag * 1000}
+
+
+def _avg_ms(fn, args: list) -> float:
+    t0 = time.perf_counter()
+    for a in args:
+        fn(a)
+    return (time.perf_counter() - t0) * 1000 / len(args)
+
+
+def _like_for_date(date_iso: str):
+    # старый вариант list_bookings_for_date
+    with db.connection() as con:
+        return con.execute("""
+            SELECT id, service_title, team_size, name, phone, slot_iso, status, confirmed_by_name
+            FROM bookings WHERE slot_iso LIKE ? ORDER BY slot_iso ASC
+        """, (date_iso + "T%",)).fetchall()
+
+
+def bench_indexes(rows: int, samples: int = 50) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        dates = seed_bookings(rows, days=3650)
+        with db.connection() as con:
+            con.execute("ANALYZE")
+            con.commit()
+        rnd = random.Random(2)
+        picked = [rnd.choice(dates) for _ in range(samples)]
+        slots = [d + "T13:00" for d in picked]
+
+        lo, hi = db.day_bounds(picked[0])
+        plans = {
+            "list_slot_services": query_plan(
+                "SELECT service_key FROM bookings WHERE slot_iso=? AND status IN ('pending','confirmed')",
+                (slots[0],)),
+            "list_bookings_for_date": query_plan(
+                "SELECT id FROM bookings WHERE slot_iso >= ? AND slot_iso < ? ORDER BY slot_iso", (lo, hi)),
+            "by_user": query_plan("SELECT id FROM bookings WHERE tg_user_id=?", (1,)),
+        }
+        for name, plan in plans.items():
+            assert "USING INDEX" in plan or "USING COVERING INDEX" in plan, (name, plan)
+
+        res = {
+            "rows": rows,
+            "like_for_date_ms": _avg_ms(_like_for_date, picked),
+            "range_for_date_ms": _avg_ms(db.list_bookings_for_date, picked),
+            "list_slot_services_ms": _avg_ms(db.list_slot_services, slots),
+            "day_snapshot_ms": _avg_ms(db.list_active_services_for_date, picked),
+            "plans": plans,
+        }
+        db.close_pool()
+    return res
+
+
+def bench_reserve(ops: int, threads: int) -> dict:
+    """Сотни одновременных броней в один слот: двойных броней быть не должно."""
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        slot_iso = "2030-01-01T13:00"
+        slot_dt = datetime(2030, 1, 1, 13, 0, tzinfo=ZoneInfo(SETTINGS.TZ))
+        keys = list(QUESTS)
+
+        def attempt(i: int):
+            key = keys[i % len(keys)]
+            return db.reserve_booking(
+                tg_user_id=i, tg_username=None, name="Bench", phone="+79990000000",
+                service_key=key, service_title=QUESTS[key]["title"], team_size=4, slot_iso=slot_iso,
+                accepts=lambda existing: slot_accepts(key, slot_dt, existing),
+            )
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            results = list(ex.map(attempt, range(ops)))
+        elapsed = time.perf_counter() - t0
+
+        active = db.list_slot_services(slot_iso)
+        with db.connection() as con:
+            active_rows = con.execute(
+                "SELECT COUNT(*) FROM bookings WHERE slot_iso=? AND status IN ('pending','confirmed')",
+                (slot_iso,)).fetchone()[0]
+        reserved = sum(isinstance(r, db.Reserved) for r in results)
+        assert reserved == active_rows == len(active) <= 2, (reserved, active_rows, active)
+        assert len(active) < 2 or "cannibal" in active, active
+
+        db.close_pool()
+    return {
+        "attempts": ops,
+        "threads": threads,
+        "reserved": reserved,
+        "slot_taken": ops - reserved,
+        "active": sorted(active),
+        "attempts_per_sec": ops / elapsed,
+    }
+
+
+def _legacy_times_render(d: date, service_key: str, snapshot: dict[str, set[str]]) -> list[tuple[str, str]]:
+    # прежний путь times_kb_for_date: новый ZoneInfo, пересборка списка datetime, strftime на каждый слот
+    Z = ZoneInfo(SETTINGS.TZ)
+    t = datetime(d.year, d.month, d.day, SETTINGS.START_TIME.hour, SETTINGS.START_TIME.minute, tzinfo=Z)
+    end = datetime(d.year, d.month, d.day, SETTINGS.END_TIME.hour, SETTINGS.END_TIME.minute, tzinfo=Z)
+    out = []
+    while t <= end:
+        slot_iso = t.strftime("%Y-%m-%dT%H:%M")
+        if slot_allowed_by_time(service_key, t) and slot_accepts(service_key, t, snapshot.get(slot_iso, set())):
+            out.append((t.strftime("%H:%M"), slot_iso))
+        t += timedelta(minutes=SETTINGS.SLOT_MINUTES)
+    return out
+
+
+def bench_slots(ops: int) -> dict:
+    """Стоимость подготовки кнопок времени на один рендер клавиатуры."""
+    days = [date(2030, 1, 1) + timedelta(days=i) for i in range(SETTINGS.DAYS_AHEAD + 1)]
+    keys = list(QUESTS)
+    snapshot: dict[str, set[str]] = {}
+
+    def legacy(i):
+        _legacy_times_render(days[i % len(days)], keys[i % len(keys)], snapshot)
+
+    def templated(i):
+        [(s.label, s.iso) for s in free_slots_in_snapshot(keys[i % len(keys)], days[i % len(days)], snapshot)]
+
+    legacy_us = 1e6 / _ops_per_sec(legacy, ops)
+    templated_us = 1e6 / _ops_per_sec(templated, ops)
+    return {"legacy_us_per_render": legacy_us, "templated_us_per_render": templated_us,
+            "speedup": legacy_us / templated_us}
+
+
+async def _fsm_flow(storage, users: int) -> float:
+    from aiogram.fsm.storage.base import StorageKey
+
+    t0 = time.perf_counter()
+    for u in range(users):
+        key = StorageKey(bot_id=1, chat_id=u, user_id=u)
+        await storage.set_state(key, "BookingFlow:waiting_name")
+        await storage.update_data(key, {"name": "Bench"})
+        await storage.update_data(key, {"service_key": "inferno", "service_title": "Инферно", "max_team": 6})
+        await storage.update_data(key, {"team_size": 4})
+        await storage.update_data(key, {"date_iso": "2030-01-01"})
+        await storage.get_data(key)
+        await storage.get_state(key)
+    return (time.perf_counter() - t0) / users * 1e6
+
+
+def bench_fsm(ops: int) -> dict:
+    """Сценарий бронирования (set_state + 4 update_data + чтения) на пользователя."""
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from fsm_storage import SQLiteStorage
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+
+        async def run():
+            memory_us = await _fsm_flow(MemoryStorage(), ops)
+            storage = SQLiteStorage()
+            sqlite_us = await _fsm_flow(storage, ops)
+            t0 = time.perf_counter()
+            await storage.close()
+            return memory_us, sqlite_us, (time.perf_counter() - t0) * 1000
+
+        memory_us, sqlite_us, flush_ms = asyncio.run(run())
+        with db.connection() as con:
+            persisted = con.execute("SELECT COUNT(*) FROM fsm").fetchone()[0]
+        db.close_pool()
+    return {"users": ops, "memory_us_per_flow": memory_us, "sqlite_us_per_flow": sqlite_us,
+            "final_flush_ms": flush_ms, "persisted_keys": persisted}
+
+
+def bench_export(rows: int) -> dict:
+    """Пиковая память выгрузки CSV.gz не должна зависеть от числа строк."""
+    import export
+
+    out = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        small = max(1, rows // 10)
+        seed_bookings(small, days=3650)
+        path = os.path.join(tmp, "out.csv.gz")
+        for label, total in (("small", small), ("full", rows)):
+            if total > small:
+                seed_bookings(total - small, days=3650, start=date(2040, 1, 1), seed=3)
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            n = export.write_csv_gz(date(2000, 1, 1), date(2100, 1, 1), path)
+            elapsed = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert n == total, (n, total)
+            out[label] = {"rows": n, "peak_mb": peak / 2**20, "rows_per_sec": n / elapsed,
+                          "file_mb": os.path.getsize(path) / 2**20}
+        db.close_pool()
+    # память на полном объёме — в пределах нескольких МБ от малого
+    assert out["full"]["peak_mb"] < out["small"]["peak_mb"] + 8, out
+    return out
+
+
+def bench_archive(rows: int) -> dict:
+    """Перенос истории в архив: длина одной транзакции, запросы по будущим датам, полнота истории."""
+    import export
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        today = date.today()
+        seed_bookings(rows, days=(today - date(2020, 1, 1)).days)
+        future = seed_bookings(max(1, rows // 100), days=14, start=today, seed=5)
+        slots = [d + "T13:00" for d in future]
+        history = sum(1 for _ in export.export_rows(date(2000, 1, 1), date(2100, 1, 1)))
+
+        before = {
+            "day_snapshot_ms": _avg_ms(db.list_active_services_for_date, future),
+            "list_slot_services_ms": _avg_ms(db.list_slot_services, slots),
+        }
+        batches = []
+        while True:
+            t0 = time.perf_counter()
+            n = db.archive_past_bookings(today.isoformat(), 500)
+            if not n:
+                break
+            batches.append(time.perf_counter() - t0)
+        after = {
+            "day_snapshot_ms": _avg_ms(db.list_active_services_for_date, future),
+            "list_slot_services_ms": _avg_ms(db.list_slot_services, slots),
+        }
+        stats = db.archive_stats()
+        history_after = sum(1 for _ in export.export_rows(date(2000, 1, 1), date(2100, 1, 1)))
+        db.close_pool()
+
+    assert history_after == history, (history, history_after)
+    assert stats["hot_oldest"] >= today.isoformat(), stats
+    return {
+        "rows": rows,
+        "batches": len(batches),
+        "batch_avg_ms": sum(batches) / len(batches) * 1000,
+        "batch_max_ms": max(batches) * 1000,
+        "before": before,
+        "after": after,
+        "stats": stats,
+    }
+
+
+def bench_notify(chats: int = 40, rate: float = 40.0, burst: int = 5, per_chat: float = 0.2) -> dict:
+    """
+    notify.Notifier против подставной BaseSession: chat 1 получает
+    TelegramRetryAfter, chat 2 — сетевую ошибку на каждую попытку, chat 3 —
+    TelegramForbiddenError, остальные — успех. Проверяются Outcome каждого
+    получателя и то, что запросы не превышают token bucket и интервал на чат.
+    """
+    from aiogram import Bot
+    from aiogram.client.session.base import BaseSession
+    from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+    from notify import Notifier
+
+    sent: list[tuple[float, int]] = []
+
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            chat_id = method.chat_id
+            sent.append((time.monotonic(), chat_id))
+            if chat_id == 1 and sum(c == 1 for _, c in sent) == 1:
+                raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+            if chat_id == 2:
+                raise TelegramNetworkError(method=method, message="connection reset")
+            if chat_id == 3:
+                raise TelegramForbiddenError(method=method, message="bot was blocked by the user")
+            return method.__returning__.model_validate({
+                "message_id": len(sent), "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": method.text,
+            })
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+    notifier = Notifier(rate=rate, burst=burst, per_chat_interval=per_chat, max_attempts=3, base_backoff=0.05)
+    bot = Bot(token="123456:" + "A" * 35, session=FakeSession())
+
+    async def run():
+        t0 = time.perf_counter()
+        outcomes = await notifier.broadcast(bot, range(1, chats + 1), "bench")
+        return outcomes, time.perf_counter() - t0
+
+    outcomes, elapsed = asyncio.run(run())
+    by_chat = {o.chat_id: o for o in outcomes}
+    assert by_chat[1].ok and by_chat[1].attempts == 2, by_chat[1]
+    assert not by_chat[2].ok and by_chat[2].retryable and by_chat[2].attempts == 3, by_chat[2]
+    assert not by_chat[3].ok and not by_chat[3].retryable and by_chat[3].attempts == 1, by_chat[3]
+    assert all(by_chat[c].ok and by_chat[c].attempts == 1 for c in range(4, chats + 1))
+
+    eps = 0.01
+    # token bucket: в любом окне [t_i, t_j] не больше burst + rate * окно запросов
+    times = [t for t, _ in sent]
+    worst = max(j - i + 1 - (burst + rate * (times[j] - times[i]))
+                for i in range(len(times)) for j in range(i, len(times)))
+    assert worst <= 1 + rate * eps, worst
+    # один чат — не чаще одного запроса в per_chat секунд
+    last: dict[int, float] = {}
+    min_gap = float("inf")
+    for t, c in sent:
+        if c in last:
+            min_gap = min(min_gap, t - last[c])
+        last[c] = t
+    assert min_gap >= per_chat - eps, min_gap
+    return {"chats": chats, "requests": len(sent), "elapsed_s": elapsed,
+            "min_elapsed_by_rate_s": (len(sent) - burst) / rate, "min_same_chat_gap_s": min_gap,
+            "outcomes": {c: (by_chat[c].ok, by_chat[c].attempts, by_chat[c].error) for c in (1, 2, 3)}}
+
+
+def bench_outbox(retry_in: float = 1.0, max_polls: int = 10) -> dict:
+    """
+    OutboxWorker против подставной BaseSession: у чата три сообщения, первое
+    ждёт повтора через retry_in, остальные уже «готовы». Воркер должен спать
+    до повтора, а не крутить dequeue_outbox, и доставить все три по порядку.
+    """
+    from aiogram import Bot
+    from aiogram.client.session.base import BaseSession
+    from notify import Notifier
+    import db_async as booking_db
+    from outbox import OutboxWorker
+
+    sent: list[tuple[float, str]] = []
+
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            sent.append((time.monotonic(), method.text))
+            return method.__returning__.model_validate({
+                "message_id": len(sent), "date": 0, "chat": {"id": method.chat_id, "type": "private"}, "text": method.text,
+            })
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+    polls = 0
+    dequeue = booking_db.dequeue_outbox
+
+    async def counting_dequeue(now, limit):
+        nonlocal polls
+        polls += 1
+        return await dequeue(now, limit)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        now = time.time()
+        first, *_ = db.enqueue_messages([(10, f"m{i}", None) for i in range(3)], now)
+        db.mark_outbox_failed(first, "bench", now + retry_in, False)
+        worker = OutboxWorker(Bot(token="123456:" + "A" * 35, session=FakeSession()),
+                              Notifier(rate=100.0, burst=10, per_chat_interval=0.01))
+
+        async def run():
+            booking_db.dequeue_outbox = counting_dequeue
+            t0 = time.monotonic()
+            task = asyncio.create_task(worker.run())
+            try:
+                await asyncio.sleep(retry_in + 0.5)
+            finally:
+                task.cancel()
+                booking_db.dequeue_outbox = dequeue
+            return t0
+
+        t0 = asyncio.run(run())
+        left = db.outbox_stats(time.time())
+        db.close_pool()
+
+    assert [t for _, t in sent] == ["m0", "m1", "m2"], sent
+    assert sent[0][0] - t0 >= retry_in - 0.05, sent[0][0] - t0
+    assert polls <= max_polls, polls
+    return {"retry_in_s": retry_in, "dequeue_calls": polls,
+            "first_sent_after_s": sent[0][0] - t0, "left": left}
+
+
+def bench_metrics(ops: int) -> dict:
+    """Накладные расходы метрик и трассировки на апдейт, плюс одно наблюдение гистограммы."""
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Update
+    import metrics
+    import tracing
+
+    async def noop(message):
+        return None
+
+    update = Update.model_validate({
+        "update_id": 1,
+        "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+                    "from": {"id": 1, "is_bot": False, "first_name": "B"}, "text": "hi"},
+    })
+    bot = Bot(token="123456:" + "A" * 35)
+
+    async def feed(dp: Dispatcher) -> float:
+        t0 = time.perf_counter()
+        for _ in range(ops):
+            await dp.feed_update(bot, update)
+        return (time.perf_counter() - t0) / ops * 1e6
+
+    def dispatcher(*instruments) -> Dispatcher:
+        dp = Dispatcher()
+        dp.message.register(noop)
+        for instrument in instruments:
+            instrument(dp)
+        return dp
+
+    async def run():
+        plain = dispatcher()
+        instrumented = dispatcher(metrics.instrument_dispatcher, tracing.instrument_dispatcher)
+        await feed(plain)  # прогрев
+        res = {"plain_us_per_update": await feed(plain)}
+        for sample in (0.0, 1.0):
+            tracing.TRACE_SAMPLE = sample
+            res[f"instrumented_sample_{sample:g}_us_per_update"] = await feed(instrumented)
+        tracing.TRACE_SAMPLE = 0.0
+        return res
+
+    res = asyncio.run(run())
+    h = metrics.Histogram("bench_seconds", "bench", ("x",))
+    res["observe_us"] = 1e6 / _ops_per_sec(lambda i: h.observe(0.003, "a"), ops)
+    return res
+
+
+def _trigger_matches_rules() -> int:
+    """
+    Триггер вместимости в БД пропускает вставку ровно тогда, когда её
+    разрешают rules.RULES (для разрешённых по времени квестов), на всех
+    временах сетки и всех масках занятости.
+    """
+    from rules import MASK_SERVICES, RULES
+
+    checked = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        with db.connection() as con:
+            for dt in generate_slots_for_date(date(2030, 1, 1)):
+                slot_iso = dt.strftime("%Y-%m-%dT%H:%M")
+                for occupied in range(RULES.masks):
+                    for key in QUESTS:
+                        if not RULES.time_allows(key, dt.time()):
+                            continue
+                        con.execute("SAVEPOINT t")
+                        # занятые — вставкой с rejected и UPDATE: триггер только на INSERT
+                        for k in MASK_SERVICES[occupied]:
+                            con.execute("""
+                                INSERT INTO bookings (created_at, tg_user_id, name, phone, service_key,
+                                                      service_title, team_size, slot_iso, status)
+                                VALUES ('', 1, '', '', ?, '', 2, ?, 'rejected')
+                            """, (k, slot_iso))
+                        con.execute("UPDATE bookings SET status='confirmed' WHERE slot_iso=?", (slot_iso,))
+                        try:
+                            con.execute("""
+                                INSERT INTO bookings (created_at, tg_user_id, name, phone, service_key,
+                                                      service_title, team_size, slot_iso, status)
+                                VALUES ('', 1, '', '', ?, '', 2, ?, 'pending')
+                            """, (key, slot_iso))
+                            inserted = True
+                        except sqlite3.IntegrityError:
+                            inserted = False
+                        con.execute("ROLLBACK TO t")
+                        con.execute("RELEASE t")
+                        want = RULES.accepts(key, dt.time(), occupied)
+                        assert inserted == want, (slot_iso, key, sorted(MASK_SERVICES[occupied]), inserted, want)
+                        checked += 1
+            # повторный init_db не трогает совпадающий триггер
+            before = con.execute("SELECT sql FROM sqlite_master WHERE name=?", (db.CAPACITY_TRIGGER,)).fetchone()
+        db.init_db()
+        with db.connection() as con:
+            after = con.execute("SELECT sql FROM sqlite_master WHERE name=?", (db.CAPACITY_TRIGGER,)).fetchone()
+        assert before == after == (RULES.trigger_sql(db.CAPACITY_TRIGGER),)
+        db.close_pool()
+    return checked
+
+
+def bench_rules(ops: int) -> dict:
+    """Сверка скомпилированных правил с прежними на всех минутах/квестах/масках и цена решения."""
+    import rules
+    from rules import MASK_SERVICES
+
+    check = rules.verify_against_legacy(minutes_step=1)
+    assert not check["mismatches"], check["mismatches"][:10]
+
+    trigger = _trigger_matches_rules()
+
+    rnd = random.Random(4)
+    keys = list(QUESTS)
+    times = [dt.time() for dt in generate_slots_for_date(date(2030, 1, 1))]
+    cases = [(rnd.choice(keys), rnd.choice(times), rnd.randrange(rules.RULES.masks)) for _ in range(ops)]
+    sets = [(k, t, set(MASK_SERVICES[m])) for k, t, m in cases]
+    legacy_us = 1e6 / _ops_per_sec(lambda i: rules.legacy_accepts(*sets[i]), ops)
+    compiled_us = 1e6 / _ops_per_sec(lambda i: rules.RULES.accepts(*cases[i]), ops)
+    # как в booking_logic: таблица слота по "HH:MM" (TEMPLATE_BY_LABEL) и бит квеста
+    from booking_logic import TEMPLATE_BY_LABEL
+    from rules import SERVICE_BITS as bits
+    labeled = [(TEMPLATE_BY_LABEL[t.strftime("%H:%M")].free, bits[k], m) for k, t, m in cases]
+    assert all(bool(f[m] & b) == rules.RULES.accepts(*c) for (f, b, m), c in zip(labeled, cases))
+    table_us = 1e6 / _ops_per_sec(lambda i: labeled[i][0][labeled[i][2]] & labeled[i][1], ops)
+    return {"checked": check["checked"], "classes": check["classes"], "trigger_checked": trigger,
+            "legacy_us_per_check": legacy_us, "rules_accepts_us_per_check": compiled_us,
+            "precomputed_table_us_per_check": table_us, "speedup": legacy_us / table_us}
+
+
+def bench_firstfree(days: int, ops: int) -> dict:
+    """Ближайшие свободные слоты и счётчики по дням, когда занят весь горизонт, кроме последнего дня."""
+    import booking_logic
+    from occupancy import INDEX, local_today
+
+    today = local_today()
+    now = datetime.combine(today, datetime.min.time(), tzinfo=ZoneInfo(SETTINGS.TZ))
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        rows = [
+            ("2020-01-01T00:00:00", 1, None, "Bench", "+79990000000", "cannibal", "Каннибал", 4, s.iso, "confirmed")
+            for i in range(days)
+            for s in booking_logic.slots_for_date(today + timedelta(days=i))
+        ]
+        with db.connection() as con:
+            con.executemany("""
+                INSERT INTO bookings (created_at, tg_user_id, tg_username, name, phone,
+                                      service_key, service_title, team_size, slot_iso, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            con.commit()
+
+        async def timed(n: int, fn, *args, **kwargs):
+            t0 = time.perf_counter()
+            for _ in range(n):
+                res = await fn(*args, **kwargs)
+            return (time.perf_counter() - t0) / n * 1000, res
+
+        async def run():
+            n = max(1, ops // 100)
+            out = {
+                "search": await timed(n, booking_logic.first_free_slots, "cannibal", now, days=days, limit=8),
+                "counts": await timed(n, booking_logic.free_counts, "cannibal", now, days=days),
+            }
+            await asyncio.to_thread(INDEX.load, today, days)
+            out["search_index"] = await timed(n, booking_logic.first_free_slots, "cannibal", now, days=days, limit=8)
+            out["counts_index"] = await timed(n, booking_logic.free_counts, "cannibal", now, days=days)
+            return out
+
+        res = asyncio.run(run())
+        db.close_pool()
+    found = res["search_index"][1]
+    assert found == res["search"][1] and found and found[0].dt.date() == today + timedelta(days=days), found[:1]
+    counts = res["counts_index"][1]
+    assert counts == res["counts"][1] and not any(counts[:-1]) and counts[-1], counts
+    return {
+        "days": days, "busy_slots": len(rows), "first": found[0].iso,
+        "first_free_index_ms": res["search_index"][0], "first_free_one_query_ms": res["search"][0],
+        "date_counts_index_ms": res["counts_index"][0], "date_counts_one_query_ms": res["counts"][0],
+    }
+
+
+def _timeit(fn, args: list, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for a in args:
+            fn(a)
+        runs.append((time.perf_counter() - t0) / len(args) * 1e6)
+    return {"us_per_op": statistics.median(runs), "min_us": min(runs), "ops": len(args), "repeat": repeat}
+
+
+def _atimeit(fn, args: list, repeat: int) -> dict:
+    async def run():
+        runs = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for a in args:
+                await fn(*a)
+            runs.append((time.perf_counter() - t0) / len(args) * 1e6)
+        return runs
+
+    runs = asyncio.run(run())
+    return {"us_per_op": statistics.median(runs), "min_us": min(runs), "ops": len(args), "repeat": repeat}
+
+
+def bench_suite(rows: int, days: int, seed: int, ops: int, repeat: int) -> dict:
+    """Медиана времени на вызов (мкс) для основных функций на базе из rows броней за days дней."""
+    import db_async
+    from occupancy import INDEX, local_today
+
+    rnd = random.Random(seed)
+    keys = list(QUESTS)
+    today = local_today()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        # история заканчивается на горизонте записи, как в рабочей базе
+        start = today - timedelta(days=max(0, days - SETTINGS.DAYS_AHEAD - 1))
+        dates = [date.fromisoformat(d) for d in seed_bookings(rows, days, start=start, seed=seed)]
+        INDEX.load(today)
+        horizon = [today + timedelta(days=i) for i in range(SETTINGS.DAYS_AHEAD + 1)]
+        past = [d for d in dates if d < today] or horizon
+
+        picked = [rnd.choice(dates) for _ in range(ops)]
+        slots = [rnd.choice(slots_for_date(d)) for d in picked]
+        team = [rnd.randint(2, 6) for _ in range(ops)]
+
+        results["generate_slots_for_date"] = _timeit(generate_slots_for_date, picked, repeat)
+        results["calc_price"] = _timeit(
+            lambda i: calc_price(keys[i % len(keys)], team[i], slots[i].dt), list(range(ops)), repeat)
+        results["list_slot_services"] = _timeit(db.list_slot_services, [s.iso for s in slots], repeat)
+        results["list_bookings_for_date"] = _timeit(
+            db.list_bookings_for_date, [d.isoformat() for d in picked[:max(1, ops // 10)]], repeat)
+
+        def avail_args(days_: list[date]) -> list[tuple]:
+            out = []
+            for i in range(ops):
+                s = rnd.choice(slots_for_date(rnd.choice(days_)))
+                out.append((keys[i % len(keys)], s.iso, s.dt))
+            return out
+
+        # в горизонте ответ даёт индекс в памяти, за его пределами — запрос в БД через пул потоков
+        results["slot_available_for_service.index"] = _atimeit(
+            slot_available_for_service, avail_args(horizon), repeat)
+        results["slot_available_for_service.db"] = _atimeit(
+            slot_available_for_service, avail_args(past), repeat)
+
+        # каждая вставка — в свой свободный слот далеко в будущем, чтобы не упереться в триггер ёмкости
+        free = (
+            s.iso
+            for d in itertools.count()
+            for s in slots_for_date(date(2090, 1, 1) + timedelta(days=d))
+        )
+
+        def create(i: int):
+            key, slot_iso = keys[i % len(keys)], next(free)
+            db.create_booking(tg_user_id=i, tg_username=None, name="Bench", phone="+79990000000",
+                              service_key=key, service_title=QUESTS[key]["title"], team_size=4,
+                              slot_iso=slot_iso)
+
+        results["create_booking"] = _timeit(create, list(range(max(1, ops // 10))), repeat)
+        db_async.shutdown()
+
+    return {
+        "meta": {
+            "rows": rows, "days": days, "seed": seed, "ops": ops, "repeat": repeat,
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+        },
+        "results": results,
+    }
+
+
+_STARTUP_SCRIPT = """
+import json, time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+import db, occupancy
+from bot import build_dispatcher
+db.init_db()
+t2 = time.perf_counter()
+occupancy.INDEX.load(occupancy.local_today())
+t3 = time.perf_counter()
+build_dispatcher()
+t4 = time.perf_counter()
+print(json.dumps({{"import": t1 - t0, "init_db": t2 - t1, "occupancy_load": t3 - t2, "build_dispatcher": t4 - t3}}))
+"""
+
+
+def bench_expiry(rows: int) -> dict:
+    """
+    rows ожидающих броней: загрузка сроков в кучу, снятие пачками по подставным
+    часам; после — сверка индекса занятости с БД и сообщений в outbox.
+    Плюс старые pending на уже прошедшие слоты: снимаются сразу и без сообщений.
+    """
+    import booking_logic
+    from expiry import PendingExpiry
+    from occupancy import INDEX, local_today
+
+    ttl = 3600.0
+    base = datetime.now(ZoneInfo("UTC")).replace(tzinfo=None, microsecond=0)
+    today = local_today()
+    per_day = booking_logic.slots_for_date(today + timedelta(days=1))
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        # по брони на слот; created_at — через секунду, чтобы сроки шли по порядку
+        data = [
+            ((base + timedelta(seconds=i)).isoformat(), i + 1, None, "Bench", "+79990000000",
+             "cannibal", "Каннибал", 4, f"{today + timedelta(days=1 + i // len(per_day))}T{per_day[i % len(per_day)].iso[11:]}",
+             "pending")
+            for i in range(rows)
+        ]
+        past = max(1, rows // 10)
+        data += [
+            ((base + timedelta(seconds=rows + j)).isoformat(), rows + j + 1, None, "Bench", "+79990000000",
+             "cannibal", "Каннибал", 4, f"{today - timedelta(days=1 + j // len(per_day))}T{per_day[j % len(per_day)].iso[11:]}",
+             "pending")
+            for j in range(past)
+        ]
+        with db.connection() as con:
+            con.executemany("""
+                INSERT INTO bookings (created_at, tg_user_id, tg_username, name, phone,
+                                      service_key, service_title, team_size, slot_iso, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, data)
+            con.commit()
+        INDEX.load(today)
+        clock = [base.replace(tzinfo=ZoneInfo("UTC")).timestamp()]
+        exp = PendingExpiry(ttl=ttl, clock=lambda: clock[0])
+
+        async def run():
+            t0 = time.perf_counter()
+            loaded = await exp.load()
+            load_ms = (time.perf_counter() - t0) * 1000
+            early = 0  # до истечения TTL снимаются только брони на прошедшие слоты
+            while n := await exp.scheduler.run_once():
+                early += n
+            with db.connection() as con:
+                early_queued = con.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            # половина броней просрочена
+            clock[0] += ttl + rows // 2 - 1
+            batches = []
+            while True:
+                t0 = time.perf_counter()
+                if not await exp.scheduler.run_once():
+                    break
+                batches.append(time.perf_counter() - t0)
+            return loaded, load_ms, early, early_queued, batches
+
+        loaded, load_ms, early, early_queued, batches = asyncio.run(run())
+        diff = INDEX.verify()
+        with db.connection() as con:
+            statuses = dict(con.execute("SELECT status, COUNT(*) FROM bookings GROUP BY status").fetchall())
+            queued = con.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        db.close_pool()
+
+    assert loaded == rows + past and early == past and early_queued == 0, (loaded, early, early_queued)
+    assert exp.expired == rows // 2 + past == statuses.get("expired"), (exp.expired, statuses)
+    assert queued == rows // 2, queued
+    assert statuses.get("pending") == rows - rows // 2 == len(exp.scheduler), statuses
+    assert not diff, diff[:5]
+    return {
+        "rows": rows,
+        "load_ms": load_ms,
+        "expired": exp.expired,
+        "batches": len(batches),
+        "batch_avg_ms": sum(batches) / len(batches) * 1000 if batches else 0.0,
+        "batch_max_ms": max(batches, default=0.0) * 1000,
+    }
+
+
+def bench_reminders(bookings: int, step: float = 600.0) -> dict:
+    """
+    Напоминания на подставных часах: часы идут шагами по step секунд, в середине
+    процесс «падает» и 30 часов не работает, затем новый ReminderService
+    загружается из БД. Отправленное сверяется с ожидаемым, посчитанным отдельно:
+    каждое напоминание — не больше одного раза, не раньше срока и не после начала слота.
+    """
+    import booking_logic
+    import reminders
+    from occupancy import local_today
+
+    today = local_today()
+    t0 = datetime.combine(today, datetime.min.time(), tzinfo=ZoneInfo(SETTINGS.TZ)).timestamp()
+    per_day = booking_logic.slots_for_date(today + timedelta(days=1))
+    slots = [f"{today + timedelta(days=i // len(per_day))}T{per_day[i % len(per_day)].iso[11:]}" for i in range(bookings)]
+    rnd = random.Random(1)
+    cancelled = set(rnd.sample(range(bookings), bookings // 20))
+    with tempfile.TemporaryDirectory() as tmp:
+        _seed_db(os.path.join(tmp, "bench.sqlite3"))
+        with db.connection() as con:
+            con.executemany("""
+                INSERT INTO bookings (id, created_at, tg_user_id, tg_username, name, phone,
+                                      service_key, service_title, team_size, slot_iso, status)
+                VALUES (?, '2020-01-01T00:00:00', ?, NULL, 'Bench', '+79990000000', 'cannibal', 'Каннибал', 4, ?, 'pending')
+            """, [(i + 1, i + 1, slot) for i, slot in enumerate(slots)])
+            con.commit()
+        t = time.perf_counter()
+        for i, slot in enumerate(slots):
+            db.confirm_booking(i + 1, 1, "bench", lambda s: reminders.plan(s, now=t0))
+        confirm_ms = (time.perf_counter() - t) / bookings * 1000
+        with db.connection() as con:
+            # отменённые после подтверждения — их напоминания должны пропуститься
+            con.executemany("UPDATE bookings SET status='rejected' WHERE id=?", [(i + 1,) for i in cancelled])
+            planned = con.execute("SELECT booking_id, kind, due_at, slot_at FROM reminders").fetchall()
+            con.commit()
+
+        last_slot = max(r[3] for r in planned)
+        crash_at = t0 + (last_slot - t0) // 2 // step * step
+        back_at = crash_at + 30 * 3600
+        clock = [t0]
+        batches = []
+
+        async def drive(svc: reminders.ReminderService, until: float):
+            while clock[0] <= until:
+                while True:
+                    b = time.perf_counter()
+                    if not await svc.scheduler.run_once():
+                        break
+                    batches.append(time.perf_counter() - b)
+                nxt = svc.scheduler.next_at()
+                if nxt is None:
+                    break
+                # пустые шаги ничего не делают — перескакиваем к шагу с ближайшим сроком
+                clock[0] = max(clock[0] + step, t0 + -(-(nxt - t0) // step) * step)
+
+        async def run():
+            first = reminders.ReminderService(clock=lambda: clock[0], pause=0)
+            b = time.perf_counter()
+            loaded = await first.load()
+            load_ms = (time.perf_counter() - b) * 1000
+            await drive(first, crash_at)
+            clock[0] = back_at
+            second = reminders.ReminderService(clock=lambda: clock[0], pause=0)
+            reloaded = await second.load()
+            await drive(second, last_slot + step)
+            return loaded, load_ms, reloaded, first.sent + second.sent, first.skipped + second.skipped
+
+        loaded, load_ms, reloaded, sent, skipped = asyncio.run(run())
+        with db.connection() as con:
+            outbox_rows = con.execute("SELECT chat_id, text, next_attempt_at FROM outbox").fetchall()
+            left = con.execute("SELECT COUNT(*) FROM reminders WHERE status='pending'").fetchone()[0]
+        db.close_pool()
+
+    # ожидаемое: момент обработки — ближайший шаг не раньше срока (или возврат после простоя)
+    def tick(due: float) -> float:
+        at = t0 + -(-(due - t0) // step) * step
+        return back_at if crash_at < at < back_at else at
+
+    by_booking: dict[int, list[tuple[str, float]]] = {}
+    for booking_id, kind, due_at, _ in planned:
+        by_booking.setdefault(booking_id, []).append((kind, due_at))
+    expected = {}
+    for booking_id, kind, due_at, slot_at in planned:
+        at = tick(due_at)
+        if booking_id - 1 in cancelled or slot_at <= at:
+            continue
+        if any(due_at < d <= at for _, d in by_booking[booking_id]):
+            continue
+        expected[(booking_id, kind)] = at
+    actual = {}
+    for chat_id, text, at in outbox_rows:
+        key = (chat_id, "24h" if "завтра" in text else "2h")
+        assert key not in actual, f"duplicate reminder {key}"
+        actual[key] = at
+    assert actual == expected, (len(actual), len(expected),
+                                sorted(set(actual.items()) ^ set(expected.items()))[:5])
+    assert sent == len(actual) and sent + skipped == len(planned) and left == 0, (sent, skipped, left)
+    assert reloaded < loaded
+    return {
+        "bookings": bookings,
+        "reminders": len(planned),
+        "sent": sent,
+        "skipped": skipped,
+        "pending_after_restart": reloaded,
+        "confirm_with_plan_ms": confirm_ms,
+        "load_ms": load_ms,
+        "batches": len(batches),
+        "batch_avg_ms": sum(batches) / len(batches) * 1000,
+        "batch_max_ms": max(batches) * 1000,
+    }
+
+
+def _startup_once(mode: str, module: str, db_path: str) -> tuple[dict, dict]:
+    import subprocess
+
+    env = {**os.environ, "MODE": mode, "BOT_TOKEN": "123456:" + "A" * 35, "DB_PATH": db_path,
+           "WEBHOOK_BASE": "https://bench.invalid", "WEBHOOK_PATH": "/tg/bench"}
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", _STARTUP_SCRIPT.format(module=module)],
+                          env=env, capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    # importtime: "import time: self | cumulative | name", вложенность — по 2 пробела перед name;
+    # берём сам модуль и его прямые импорты (aiogram, fastapi, db, ...)
+    imports = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if (len(name) - len(name.lstrip())) // 2 <= 1:
+            imports[name.strip()] = int(cumulative) / 1e6
+    return json.loads(proc.stdout.strip().splitlines()[-1]), imports
+
+
+def bench_startup(repeat: int) -> dict:
+    """Холодный старт: импорт (с разбивкой по верхнеуровневым модулям) и шаги инициализации."""
+    results = {}
+    breakdown = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode, module in (("local", "bot"), ("prod", "web")):
+            db_path = os.path.join(tmp, f"{mode}.sqlite3")
+            _startup_once(mode, module, db_path)  # прогрев: .pyc и файл базы
+            runs = [_startup_once(mode, module, db_path) for _ in range(repeat)]
+            for step in runs[0][0]:
+                results[f"{mode}.{step}"] = {
+                    "us_per_op": statistics.median(r[0][step] for r in runs) * 1e6,
+                    "min_us": min(r[0][step] for r in runs) * 1e6, "ops": 1, "repeat": repeat,
+                }
+            last = runs[-1][1]
+            breakdown[mode] = {k: round(v * 1000, 1) for k, v in sorted(last.items(), key=lambda kv: -kv[1])[:12]}
+    return {"meta": {"repeat": repeat, "python": platform.python_version()},
+            "results": results, "imports_ms": breakdown}
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> dict:
+    """Сравнение медиан с базовым прогоном; regression — медленнее больше чем на threshold."""
+    out = {}
+    for name, cur in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        ratio = cur["us_per_op"] / base["us_per_op"] if base["us_per_op"] else float("inf")
+        out[name] = {
+            "baseline_us": base["us_per_op"],
+            "current_us": cur["us_per_op"],
+            "ratio": ratio,
+            "regression": ratio > 1 + threshold,
+        }
+    return out
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("scenario", choices=["pool", "loop", "indexes", "reserve", "slots", "fsm", "export", "archive", "metrics", "notify", "outbox", "rules", "firstfree", "expiry", "reminders", "startup", "suite"])
+    p.add_argument("--ops", type=int, default=5000)
+    p.add_argument("--rows", type=int, default=None, help="по умолчанию 500000 (export — 1000000)")
+    p.add_argument("--threads", type=int, default=32)
+    p.add_argument("--days", type=int, default=3650)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--save", metavar="FILE")
+    p.add_argument("--compare", metavar="FILE")
+    p.add_argument("--threshold", type=float, default=0.2)
+    args = p.parse_args()
+
+    if args.scenario == "pool":
+        out = bench_pool(args.ops)
+    elif args.scenario == "loop":
+        out = bench_loop()
+    elif args.scenario == "indexes":
+        out = bench_indexes(args.rows or 500_000)
+    elif args.scenario == "reserve":
+        out = bench_reserve(args.ops, args.threads)
+    elif args.scenario == "slots":
+        out = bench_slots(args.ops)
+    elif args.scenario == "fsm":
+        out = bench_fsm(args.ops)
+    elif args.scenario == "export":
+        out = bench_export(args.rows or 1_000_000)
+    elif args.scenario == "archive":
+        out = bench_archive(args.rows or 500_000)
+    elif args.scenario == "metrics":
+        out = bench_metrics(args.ops)
+    elif args.scenario == "notify":
+        out = bench_notify()
+    elif args.scenario == "outbox":
+        out = bench_outbox()
+    elif args.scenario == "rules":
+        out = bench_rules(args.ops)
+    elif args.scenario == "firstfree":
+        out = bench_firstfree(args.days, args.ops)
+    elif args.scenario == "expiry":
+        out = bench_expiry(args.rows or 500_000)
+    elif args.scenario == "reminders":
+        out = bench_reminders(args.ops)
+    else:
+        if args.scenario == "startup":
+            out = bench_startup(args.repeat)
+        else:
+            out = bench_suite(args.rows or 500_000, args.days, args.seed, args.ops, args.repeat)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(out, f, indent=2)
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                out["comparison"] = compare(out, json.load(f), args.threshold)
+    print(json.dumps(out, indent=2))
+    if any(c["regression"] for c in out.get("comparison", {}).values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,199 @@
 # booking_logic.py
 from __future__ import annotations
 
-from datetime import datetime, timedelta, date
+from dataclasses import dataclass
+from datetime import datetime, timedelta, date, time
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
-from config import SETTINGS, QUESTS, is_compatible
-import db as booking_db
+from config import SETTINGS, QUESTS
+import db_async as booking_db
+from occupancy import INDEX as OCCUPANCY
+from rules import RULES, SERVICE_BITS, mask_of
 
 
-def tz():
+@lru_cache(maxsize=1)
+def tz() -> ZoneInfo:
     return ZoneInfo(SETTINGS.TZ)
 
 
 def generate_slots_for_date(d: date) -> list[datetime]:
-    Z = tz()
-    start = datetime(d.year, d.month, d.day, SETTINGS.START_TIME.hour, SETTINGS.START_TIME.minute, tzinfo=Z)
-    end = datetime(d.year, d.month, d.day, SETTINGS.END_TIME.hour, SETTINGS.END_TIME.minute, tzinfo=Z)
+    return [s.dt for s in slots_for_date(d)]
+
+
+def slot_allowed_by_time(service_key: str, slot_dt: datetime) -> bool:
+    # окно старта квеста и ограничения части дня — из config.PERIODS (rules.py)
+    return RULES.time_allows(service_key, slot_dt.time())
+
+
+# ---------- шаблон слотов ----------
+# Время начала слотов и допустимые по времени квесты не зависят от даты,
+# поэтому считаются один раз из START_TIME/END_TIME/SLOT_MINUTES.
+
+@dataclass(frozen=True)
+class SlotTemplate:
+    start: time
+    label: str          # "HH:MM"
+    allowed_mask: int   # биты SERVICE_BITS квестов, которым время разрешено
+    free: tuple[int, ...]  # [маска занятых] -> кого ещё можно поставить (rules.RULES)
+
+
+@dataclass(frozen=True)
+class Slot:
+    dt: datetime
+    iso: str            # ключ слота в БД: YYYY-MM-DDTHH:MM
+    label: str
+    allowed_mask: int
+    free: tuple[int, ...]
+
+
+def _build_template() -> tuple[SlotTemplate, ...]:
+    base = datetime.combine(date(2000, 1, 1), SETTINGS.START_TIME)
+    end = datetime.combine(date(2000, 1, 1), SETTINGS.END_TIME)
     step = timedelta(minutes=SETTINGS.SLOT_MINUTES)
 
-    out: list[datetime] = []
-    t = start
+    out: list[SlotTemplate] = []
+    t = base
     while t <= end:
-        out.append(t)
+        mask = RULES.time_masks[RULES.time_class(t.time())]
+        out.append(SlotTemplate(t.time(), t.strftime("%H:%M"), mask, RULES.table(t.time())))
         t += step
-    return out
+    return tuple(out)
 
 
-def slot_allowed_by_time(service_key: str, slot_dt: datetime) -> bool:
-    q = QUESTS[service_key]
+SLOT_TEMPLATE = _build_template()
+# "HH:MM" -> шаблон: проверка слота сетки — одна выборка из готовой таблицы
+TEMPLATE_BY_LABEL = {t.label: t for t in SLOT_TEMPLATE}
 
-    # общий лимит по квесту (например 20:30 для всех кроме каннибала)
-    if slot_dt.time() > q["last_start"]:
-        return False
 
-    # после 22:00 — только Каннибал
-    if slot_dt.time() >= SETTINGS.NIGHT_FROM:
-        return service_key == "cannibal"
+@lru_cache(maxsize=64)
+def slots_for_date(d: date) -> tuple[Slot, ...]:
+    Z = tz()
+    prefix = d.isoformat() + "T"
+    return tuple(
+        Slot(datetime.combine(d, t.start, tzinfo=Z), prefix + t.label, t.label, t.allowed_mask, t.free)
+        for t in SLOT_TEMPLATE
+    )
+
 
-    return True
+@lru_cache(maxsize=1024)
+def parse_slot_iso(slot_iso: str) -> datetime:
+    return datetime.strptime(slot_iso, "%Y-%m-%dT%H:%M").replace(tzinfo=tz())
 
 
-def slot_available_for_service(service_key: str, slot_iso: str, slot_dt: datetime) -> bool:
-    # правило времени
-    if not slot_allowed_by_time(service_key, slot_dt):
-        return False
+def slot_accepts(service_key: str, slot_dt: datetime, existing: set[str]) -> bool:
+    # время, вместимость слота и комнаты — одна скомпилированная таблица (rules.py)
+    return RULES.accepts(service_key, slot_dt.time(), mask_of(existing))
 
-    existing = booking_db.list_slot_services(slot_iso)
 
-    # после 22:00 — только один Каннибал (без параллелей)
-    if slot_dt.time() >= SETTINGS.NIGHT_FROM:
-        if service_key != "cannibal":
+async def slot_available_for_service(service_key: str, slot_iso: str, slot_dt: datetime) -> bool:
+    tpl = TEMPLATE_BY_LABEL.get(slot_iso[11:])
+    if tpl is None:  # время вне сетки слотов
+        if not slot_allowed_by_time(service_key, slot_dt):
             return False
-        return len(existing) == 0
+        free = RULES.table(slot_dt.time())
+    else:
+        free = tpl.free
+    bit = SERVICE_BITS[service_key]
+    # без похода в БД, если слот отсекается правилом времени (free[0] — всё, что разрешено по времени)
+    if not free[0] & bit:
+        return False
+
+    if OCCUPANCY.covers(slot_dt.date()):
+        return bool(free[OCCUPANCY.mask(slot_iso)] & bit)
+    existing = await booking_db.list_slot_services(slot_iso)
+    return bool(free[mask_of(existing)] & bit)
+
+
+async def day_snapshot(d: date) -> dict[str, set[str]]:
+    # slot_iso -> {service_key}: в горизонте — из индекса в памяти, иначе одним запросом в БД
+    if OCCUPANCY.covers(d):
+        return OCCUPANCY.day(d)
+    return await booking_db.list_active_services_for_date(d.isoformat())
+
+
+def slot_free_in_snapshot(service_key: str, slot_iso: str, slot_dt: datetime,
+                          snapshot: dict[str, set[str]]) -> bool:
+    return slot_accepts(service_key, slot_dt, snapshot.get(slot_iso, set()))
+
+
+def free_slots_in_snapshot(service_key: str, d: date,
+                           snapshot: dict[str, set[str]], after: datetime | None = None) -> list[Slot]:
+    """Свободные для квеста слоты даты; с after — только начинающиеся позже (сегодня)."""
+    bit = SERVICE_BITS[service_key]
+    return [s for s in slots_for_date(d)
+            if s.allowed_mask & bit and (after is None or s.dt > after)
+            and s.free[mask_of(snapshot.get(s.iso, ()))] & bit]
+
+
+# ---------- ближайшие свободные ----------
+async def occupancy_masks(start: date, end: date):
+    """
+    Функция slot_iso -> маска занятых квестов для дат [start, end): из индекса,
+    если он покрывает диапазон, иначе одним запросом по всему диапазону.
+    """
+    if OCCUPANCY.covers(start) and OCCUPANCY.covers(end - timedelta(days=1)):
+        return OCCUPANCY.mask
+    masks: dict[str, int] = {}
+    for slot_iso, key in await booking_db.list_active_in_range(start.isoformat(), end.isoformat()):
+        masks[slot_iso] = masks.get(slot_iso, 0) | SERVICE_BITS.get(key, 0)
+    return lambda slot_iso: masks.get(slot_iso, 0)
+
+
+async def first_free_slots(service_key: str, now: datetime, days: int = SETTINGS.DAYS_AHEAD,
+                           limit: int = 8) -> list[Slot]:
+    """limit самых ранних свободных для квеста слотов позже now в пределах days дней."""
+    start = now.date()
+    end = start + timedelta(days=days + 1)
+    mask = await occupancy_masks(start, end)
+    bit = SERVICE_BITS[service_key]
+    Z = tz()
+    out: list[Slot] = []
+    d = start
+    while d < end:
+        prefix = d.isoformat() + "T"
+        for t in SLOT_TEMPLATE:
+            if not t.allowed_mask & bit or not t.free[mask(prefix + t.label)] & bit:
+                continue
+            dt = datetime.combine(d, t.start, tzinfo=Z)
+            if dt <= now:
+                continue
+            out.append(Slot(dt, prefix + t.label, t.label, t.allowed_mask, t.free))
+            if len(out) >= limit:
+                return out
+        d += timedelta(days=1)
+    return out
+
 
-    # до 22:00 — максимум 2 и совместимость (каннибал + любой один другой)
-    return is_compatible(service_key, existing)
+async def free_counts(service_key: str, now: datetime, days: int = SETTINGS.DAYS_AHEAD) -> tuple[int, ...]:
+    """Число свободных для квеста слотов по дням от сегодня (сегодня — только позже now)."""
+    start = now.date()
+    mask = await occupancy_masks(start, start + timedelta(days=days + 1))
+    bit = SERVICE_BITS[service_key]
+    templates = [t for t in SLOT_TEMPLATE if t.allowed_mask & bit]
+    now_t = now.time()
+    out = []
+    for i in range(days + 1):
+        prefix = (start + timedelta(days=i)).isoformat() + "T"
+        out.append(sum(
+            1 for t in templates
+            if t.free[mask(prefix + t.label)] & bit and (i or t.start > now_t)
+        ))
+    return tuple(out)
+
+
+async def reserve_slot(*, tg_user_id: int, tg_username: str | None, name: str, phone: str,
+                       service_key: str, service_title: str, team_size: int,
+                       slot_iso: str, slot_dt: datetime):
+    # проверка правил и вставка — одна транзакция в БД, без гонки между ними;
+    # таблица слота и бит квеста берутся заранее, в транзакции — только выборка
+    free = RULES.table(slot_dt.time())
+    bit = SERVICE_BITS[service_key]
+    return await booking_db.reserve_booking(
+        tg_user_id=tg_user_id, tg_username=tg_username, name=name, phone=phone,
+        service_key=service_key, service_title=service_title, team_size=team_size, slot_iso=slot_iso,
+        accepts=lambda existing: bool(free[mask_of(existing)] & bit),
+    )
 
 
 def calc_price(service_key: str, team_size: int, slot_dt: datetime) -> int:
@@ -1,6 +1,9 @@
 # bot.py
+import asyncio
 import os
 import re
+import sys
+from functools import lru_cache
 from datetime import datetime, timedelta, date
 from zoneinfo import ZoneInfo
 
@@ -10,20 +13,31 @@ from aiogram.types import (
     Message, CallbackQuery,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 )
-from aiogram.types import Update
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException, Response
-import uvicorn
 
-import db as booking_db
+import db
+import db_async as booking_db
+import archive
+import expiry
+import metrics
+import occupancy
+import outbox
+import reminders
+import tracing
 from config import SETTINGS, QUESTS, get_admin_ids
-from booking_logic import generate_slots_for_date, slot_available_for_service, is_night_slot
+from booking_logic import (
+    day_snapshot, free_slots_in_snapshot, slot_free_in_snapshot, is_night_slot, reserve_slot, parse_slot_iso,
+    first_free_slots, free_counts, calc_price, slots_for_date,
+)
 import admin as admin_mod
+from kb_cache import TIMES_KB
+from fsm_storage import SQLiteStorage
+from notify import notify_admins
 
 
 # ---------- env ----------
@@ -45,6 +59,19 @@ if MODE != "local":
         raise RuntimeError("WEBHOOK_PATH должен начинаться с '/', например /tg/webhook_kletka_2026")
     WEBHOOK_URL = WEBHOOK_BASE.rstrip("/") + WEBHOOK_PATH
 
+# async: вебхук сразу отвечает 200, апдейты обрабатывает пул воркеров (update_queue.py)
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0").strip() == "1"
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip().lower()  # sqlite | memory
+
+# несколько процессов uvicorn (prod): вебхуком и outbox управляет только лидер (cluster.py)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+MULTI_PROCESS = MODE != "local" and WEB_CONCURRENCY > 1
+if MULTI_PROCESS:
+    db.CHANGE_LOG = True
+
 TZ = ZoneInfo(SETTINGS.TZ)
 ADMIN_IDS = set(get_admin_ids())
 
@@ -55,6 +82,7 @@ def normalize_phone(s: str) -> str:
     return re.sub(r"[ \-\(\)]", "", s.strip())
 
 
+@lru_cache(maxsize=None)
 def main_menu_kb():
     kb = InlineKeyboardBuilder()
     kb.button(text="📅 Забронировать", callback_data="action:book")
@@ -63,6 +91,7 @@ def main_menu_kb():
     return kb.as_markup()
 
 
+@lru_cache(maxsize=None)
 def category_kb():
     kb = InlineKeyboardBuilder()
     kb.button(text="🔞 Взрослые квесты (14+)", callback_data="cat:adult")
@@ -71,6 +100,7 @@ def category_kb():
     return kb.as_markup()
 
 
+@lru_cache(maxsize=None)
 def services_kb(category: str):
     kb = InlineKeyboardBuilder()
     for key, q in QUESTS.items():
@@ -82,6 +112,7 @@ def services_kb(category: str):
     return kb.as_markup()
 
 
+@lru_cache(maxsize=None)
 def team_size_kb(max_team: int):
     kb = InlineKeyboardBuilder()
     for n in range(2, max_team + 1):
@@ -92,30 +123,74 @@ def team_size_kb(max_team: int):
     return kb.as_markup()
 
 
-def dates_kb():
+DATES_PROMPT = "Выберите дату (рядом — число свободных слотов, ✖ — всё занято):"
+
+
+async def dates_kb(service_key: str):
+    now = datetime.now(TZ)
+    return _dates_kb_for(now.date(), await free_counts(service_key, now))
+
+
+# число свободных слотов — часть ключа: при изменении занятости клавиатура строится заново,
+# пока не изменилась — берётся готовая
+@lru_cache(maxsize=256)
+def _dates_kb_for(today: date, counts: tuple[int, ...]):
+    TIMES_KB.drop_before(today.isoformat())
     kb = InlineKeyboardBuilder()
-    today = datetime.now(TZ).date()
-    for i in range(0, SETTINGS.DAYS_AHEAD + 1):
+    for i, n in enumerate(counts):
         d = today + timedelta(days=i)
-        kb.button(text=d.strftime("%d.%m"), callback_data=f"date:{d.isoformat()}")
+        if n:
+            kb.button(text=f"{d.strftime('%d.%m')} · {n}", callback_data=f"date:{d.isoformat()}")
+        else:
+            kb.button(text=f"{d.strftime('%d.%m')} ✖", callback_data="date_full")
     kb.adjust(3)
+    kb.button(text="⚡ Ближайшее свободное время", callback_data="first_free")
     kb.button(text="⬅️ Назад", callback_data="back:team")
-    kb.adjust(3, 1)
+    kb.adjust(3, 1, 1)
     return kb.as_markup()
 
 
-def times_kb_for_date(d: date, service_key: str):
+async def times_kb_for_date(d: date, service_key: str, snapshot: dict[str, set[str]] | None = None):
+    # кеш на (дата, квест), сбрасывается при любом изменении броней за дату (kb_cache.py);
+    # сегодня прошедшие слоты не показываем, поэтому в ключе ещё число уже начавшихся
+    date_iso = d.isoformat()
+    now = datetime.now(TZ)
+    after = now if d <= now.date() else None
+    key = service_key if after is None else (service_key, sum(1 for s in slots_for_date(d) if s.dt <= now))
+    cached = TIMES_KB.get(date_iso, key)
+    if cached is not None:
+        return cached
+    version = TIMES_KB.version(date_iso)
+    cacheable = snapshot is None
+    if snapshot is None:
+        snapshot = await day_snapshot(d)
     kb = InlineKeyboardBuilder()
-    for slot_dt in generate_slots_for_date(d):
-        slot_iso = slot_dt.strftime("%Y-%m-%dT%H:%M")
-        if slot_available_for_service(service_key, slot_iso, slot_dt):
-            kb.button(text=slot_dt.strftime("%H:%M"), callback_data=f"slot:{slot_iso}")
+    for slot in free_slots_in_snapshot(service_key, d, snapshot, after):
+        kb.button(text=slot.label, callback_data=f"slot:{slot.iso}")
     kb.adjust(4)
     kb.button(text="⬅️ Назад к датам", callback_data="back:dates")
     kb.adjust(4, 1)
+    markup = kb.as_markup()
+    if cacheable:
+        TIMES_KB.put(date_iso, key, markup, version)
+    return markup
+
+
+FIRST_FREE_LIMIT = 8
+
+
+def first_free_kb(slots, service_key: str, team_size: int):
+    kb = InlineKeyboardBuilder()
+    for slot in slots:
+        price = calc_price(service_key, team_size, slot.dt)
+        kb.button(text=f"{slot.dt.strftime('%d.%m')} {slot.label} · {price}₽", callback_data=f"slot:{slot.iso}")
+    kb.adjust(2)
+    kb.button(text="⬅️ Назад к датам", callback_data="back:dates")
+    kb.adjust(2, 1)
     return kb.as_markup()
 
 
+@lru_cache(maxsize=None)
 def phone_kb():
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="📱 Поделиться контактом", request_contact=True)]],
@@ -235,7 +310,7 @@ async def choose_team(call: CallbackQuery, state: FSMContext):
         return
     await state.update_data(team_size=n)
     await state.set_state(BookingFlow.waiting_date)
-    await call.message.edit_text("Выберите дату:", reply_markup=dates_kb())
+    await call.message.edit_text(DATES_PROMPT, reply_markup=await dates_kb(data["service_key"]))
 
 
 async def back_to_team(call: CallbackQuery, state: FSMContext):
@@ -256,28 +331,51 @@ async def choose_date(call: CallbackQuery, state: FSMContext):
     await state.set_state(BookingFlow.waiting_time)
     await call.message.edit_text(
         f"Выберите время на {d.strftime('%d.%m.%Y')}:",
-        reply_markup=times_kb_for_date(d, service_key)
+        reply_markup=await times_kb_for_date(d, service_key)
     )
 
 
+async def first_free(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+    data = await state.get_data()
+    service_key = data["service_key"]
+    team_size = int(data["team_size"])
+    slots = await first_free_slots(service_key, datetime.now(TZ), limit=FIRST_FREE_LIMIT)
+    # «Назад к датам» обрабатывается из waiting_time
+    await state.set_state(BookingFlow.waiting_time)
+    if not slots:
+        await call.message.edit_text(
+            f"На ближайшие {SETTINGS.DAYS_AHEAD} дней свободного времени нет 😔",
+            reply_markup=first_free_kb((), service_key, team_size),
+        )
+        return
+    await call.message.edit_text("Ближайшее свободное время:", reply_markup=first_free_kb(slots, service_key, team_size))
+
+
 async def back_to_dates(call: CallbackQuery, state: FSMContext):
     await call.answer()
+    data = await state.get_data()
     await state.set_state(BookingFlow.waiting_date)
-    await call.message.edit_text("Выберите дату:", reply_markup=dates_kb())
+    await call.message.edit_text(DATES_PROMPT, reply_markup=await dates_kb(data["service_key"]))
+
+
+async def date_full(call: CallbackQuery):
+    await call.answer("На эту дату свободного времени нет", show_alert=False)
 
 
 async def choose_time(call: CallbackQuery, state: FSMContext):
     await call.answer()
     slot_iso = (call.data or "").split("slot:", 1)[-1]
-    slot_dt = datetime.strptime(slot_iso, "%Y-%m-%dT%H:%M").replace(tzinfo=TZ)
+    slot_dt = parse_slot_iso(slot_iso)
 
     data = await state.get_data()
     service_key = data["service_key"]
 
-    if not slot_available_for_service(service_key, slot_iso, slot_dt):
-        d = date.fromisoformat(data["date_iso"])
+    d = slot_dt.date()
+    snapshot = await day_snapshot(d)
+    if slot_dt <= datetime.now(TZ) or not slot_free_in_snapshot(service_key, slot_iso, slot_dt, snapshot):
         await call.message.answer("Это время недоступно. Выберите другое.")
-        await call.message.answer("Доступные времена:", reply_markup=times_kb_for_date(d, service_key))
+        await call.message.answer("Доступные времена:", reply_markup=await times_kb_for_date(d, service_key, snapshot))
         return
 
     await state.update_data(slot_iso=slot_iso)
@@ -313,16 +411,9 @@ async def got_phone(message: Message, state: FSMContext, bot: Bot):
     service_title = data["service_title"]
     team_size = int(data["team_size"])
     slot_iso = data["slot_iso"]
-    slot_dt = datetime.strptime(slot_iso, "%Y-%m-%dT%H:%M").replace(tzinfo=TZ)
+    slot_dt = parse_slot_iso(slot_iso)
 
-    if not slot_available_for_service(service_key, slot_iso, slot_dt):
-        d = date.fromisoformat(data["date_iso"])
-        await state.set_state(BookingFlow.waiting_time)
-        await message.answer("Это время стало недоступно. Выберите другое:")
-        await message.answer("Доступные времена:", reply_markup=times_kb_for_date(d, service_key))
-        return
-
-    booking_id = booking_db.create_booking(
+    result = await reserve_slot(
         tg_user_id=message.from_user.id,
         tg_username=message.from_user.username,
         name=name,
@@ -330,8 +421,16 @@ async def got_phone(message: Message, state: FSMContext, bot: Bot):
         service_key=service_key,
         service_title=service_title,
         team_size=team_size,
-        slot_iso=slot_iso
+        slot_iso=slot_iso,
+        slot_dt=slot_dt,
     )
+    if isinstance(result, booking_db.SlotTaken):
+        await state.set_state(BookingFlow.waiting_time)
+        await message.answer("Это время стало недоступно. Выберите другое:")
+        await message.answer("Доступные времена:", reply_markup=await times_kb_for_date(slot_dt.date(), service_key))
+        return
+    booking_id = result.booking_id
+    metrics.BOOKINGS.inc("created", service_key)
 
     await message.answer(
         f"✅ Заявка отправлена!\nНомер: #{booking_id}\nОжидайте подтверждения администратора.",
@@ -351,17 +450,20 @@ async def got_phone(message: Message, state: FSMContext, bot: Bot):
         f"Пользователь: {user_link} | user_id={message.from_user.id}"
     )
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, admin_text, reply_markup=admin_mod.admin_confirm_kb(booking_id))
-        except Exception:
-            pass
+    await notify_admins(bot, ADMIN_IDS, admin_text, reply_markup=admin_mod.admin_confirm_kb(booking_id))
 
     await state.clear()
 
 
+def build_storage():
+    # sqlite: состояние сценария бронирования переживает рестарт Render
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(shared=MULTI_PROCESS)
+
+
 def build_dispatcher() -> Dispatcher:
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=build_storage())
 
     dp.message.register(start, CommandStart())
     dp.message.register(cmd_help, Command("help"))
@@ -382,6 +484,8 @@ def build_dispatcher() -> Dispatcher:
     dp.callback_query.register(back_to_team, F.data == "back:team", BookingFlow.waiting_date)
 
     dp.callback_query.register(choose_date, F.data.startswith("date:"), BookingFlow.waiting_date)
+    dp.callback_query.register(first_free, F.data == "first_free", BookingFlow.waiting_date)
+    dp.callback_query.register(date_full, F.data == "date_full", BookingFlow.waiting_date)
     dp.callback_query.register(back_to_dates, F.data == "back:dates", BookingFlow.waiting_time)
 
     dp.callback_query.register(choose_time, F.data.startswith("slot:"), BookingFlow.waiting_time)
@@ -389,73 +493,37 @@ def build_dispatcher() -> Dispatcher:
 
     # ---- admin ----
     dp.message.register(admin_mod.cmd_admin, Command("admin"))
+    dp.message.register(admin_mod.cmd_check_occupancy, Command("check"))
+    dp.message.register(admin_mod.cmd_outbox, Command("outbox"))
+    dp.message.register(admin_mod.cmd_export, Command("export"))
     dp.callback_query.register(admin_mod.admin_choose_date, F.data.startswith("admin_date:"))
+    dp.callback_query.register(admin_mod.admin_bookings_page, F.data.startswith("ap:"))
     dp.callback_query.register(admin_mod.admin_confirm, F.data.startswith("admin:confirm:"))
     dp.callback_query.register(admin_mod.admin_reject, F.data.startswith("admin:reject:"))
     dp.callback_query.register(admin_mod.rules_ok, F.data.startswith("rules_ok:"))
 
+    metrics.instrument_dispatcher(dp)
+    tracing.instrument_dispatcher(dp)
     return dp
 
 
-# ---------- Webhook FastAPI ----------
-app = FastAPI()
-
-# глобальные bot/dp (для webhook режима)
-bot = Bot(token=BOT_TOKEN)
-dp = build_dispatcher()
-
-
-@app.get("/")
-def root():
-    return {"status": "ok"}
-
-
-# ВАЖНО: Render/прокси иногда делает HEAD / как health-check
-# Если не обработать — будет 405 и Render может перезапускать сервис.
-@app.head("/")
-def root_head():
-    return Response(status_code=200)
-
-
-@app.post(WEBHOOK_PATH)
-async def telegram_webhook(request: Request):
-    try:
-        data = await request.json()
-        update = Update.model_validate(data)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid update")
-
-    await dp.feed_update(bot, update)
-    return {"ok": True}
-
-
-@app.on_event("startup")
-async def on_startup():
-    booking_db.init_db()
-    # В prod работаем через webhook (Render). В local webhook не нужен.
-    if MODE != "local":
-        # На всякий случай очищаем висящий webhook и ставим новый
-        await bot.delete_webhook(drop_pending_updates=True)
-        if not WEBHOOK_URL.startswith("https://"):
-            raise RuntimeError("WEBHOOK_URL должен начинаться с https://")
-        await bot.set_webhook(WEBHOOK_URL)
-
-
-@app.on_event("shutdown")
-async def on_shutdown():
-    if MODE != "local":
-        await bot.delete_webhook()
-
-
 if __name__ == "__main__":
     # local: удобный тестовый режим (polling) — запускай с MODE=local и DEV токеном
     # prod: webhook + FastAPI (Render) — запускай с MODE=prod и PROD токеном
     if MODE == "local":
-        import asyncio
-
         async def _run_local():
-            booking_db.init_db()
+            await booking_db.init_db()
+            await occupancy.start(booking_db.run)
             _bot = Bot(token=BOT_TOKEN)
+            metrics.instrument_bot(_bot)
+            tracing.instrument_bot(_bot)
+            background = [  # noqa: F841  (держим ссылки на фоновые задачи)
+                asyncio.create_task(occupancy.midnight_roll_loop(booking_db.run)),
+                asyncio.create_task(outbox.OutboxWorker(_bot).run()),
+                asyncio.create_task(archive.archive_loop()),
+                asyncio.create_task(expiry.EXPIRY.run()),
+                asyncio.create_task(reminders.REMINDERS.run()),
+            ]
             _dp = build_dispatcher()
             # У DEV-бота вебхук не нужен
             try:
@@ -466,5 +534,16 @@ if __name__ == "__main__":
 
         asyncio.run(_run_local())
     else:
+        # FastAPI/uvicorn нужны только в prod — импортируются здесь, а не при импорте bot.py
+        import uvicorn
+
         port = int(os.environ.get("PORT", "10000"))
-        uvicorn.run(app, host="0.0.0.0", port=port)
+        if MULTI_PROCESS:
+            # приложение собирает каждый воркер сам; родителю web не нужен
+            uvicorn.run("web:app", host="0.0.0.0", port=port, workers=WEB_CONCURRENCY)
+        else:
+            # web.py импортирует bot; без этого модуль выполнился бы второй раз под именем "bot"
+            sys.modules.setdefault("bot", sys.modules[__name__])
+            import web
+
+            uvicorn.run(web.app, host="0.0.0.0", port=port)
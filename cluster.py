@@ -0,0 +1,118 @@
+# cluster.py
+"""
+Режим нескольких процессов uvicorn на одном bookings.sqlite3.
+
+LeaderLease — аренда лидерства в таблице leases: ровно один процесс
+(лидер) управляет вебхуком и фоновыми задачами, которые должны идти в
+единственном экземпляре (outbox). Если лидер пропал, аренда истекает и её
+забирает другой процесс.
+
+ChangeFeed — рассылка изменений броней между процессами: db.py пишет их в
+таблицу changes, остальные процессы читают новые записи и передают их
+своим локальным подписчикам db.subscribe (индекс занятости, кеши).
+Запись outbox в журнале будит воркер outbox лидера, если сообщение
+поставил другой процесс.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import db
+import db_async as booking_db
+import outbox
+
+log = logging.getLogger(__name__)
+
+LEASE_TTL = 30.0
+POLL_INTERVAL = 0.5
+CHANGES_KEEP = 3600.0
+
+
+class LeaderLease:
+    def __init__(self, name: str, on_acquire: Callable[[], Awaitable[None]],
+                 on_lose: Callable[[], Awaitable[None]], ttl: float = LEASE_TTL):
+        self.name = name
+        self.owner = db.PROCESS_ID
+        self.on_acquire = on_acquire
+        self.on_lose = on_lose
+        self.ttl = ttl
+        self.is_leader = False
+
+    async def _tick(self):
+        ok = await booking_db.run(db.acquire_lease, self.name, self.owner, self.ttl, time.time())
+        if ok and not self.is_leader:
+            try:
+                await self.on_acquire()
+            except Exception:
+                # не держим аренду, ничего не делая: сворачиваем начатое и отдаём её,
+                # на следующем тике попробует этот или другой процесс
+                log.exception("%s: failed to start as leader of %r", self.owner, self.name)
+                try:
+                    await self.on_lose()
+                finally:
+                    await booking_db.run(db.release_lease, self.name, self.owner)
+                return
+            self.is_leader = True
+            log.info("%s: became leader of %r", self.owner, self.name)
+        elif not ok and self.is_leader:
+            self.is_leader = False
+            log.warning("%s: lost leadership of %r", self.owner, self.name)
+            await self.on_lose()
+
+    async def run(self):
+        while True:
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("lease %r tick failed", self.name)
+            # продлеваем заметно раньше истечения
+            await asyncio.sleep(self.ttl / 3)
+
+    async def release(self):
+        if self.is_leader:
+            self.is_leader = False
+            await self.on_lose()
+            await booking_db.run(db.release_lease, self.name, self.owner)
+
+
+class ChangeFeed:
+    def __init__(self, poll_interval: float = POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.seq = 0
+        self.applied = 0
+
+    def _apply(self, rows):
+        for seq, origin, event, slot_iso, service_key in rows:
+            self.seq = seq
+            if origin == db.PROCESS_ID or event == db.OUTBOX_EVENT:
+                continue
+            db._notify(event, slot_iso, service_key)
+            self.applied += 1
+
+    async def start(self):
+        # всё, что было до старта, уже учтено загрузкой индекса из БД
+        self.seq = await booking_db.run(db.last_change_seq)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                rows = await booking_db.run(db.changes_since, self.seq)
+                if rows:
+                    await booking_db.run(self._apply, rows)
+                    # сообщения, поставленные другим процессом: будим воркер outbox (он у лидера)
+                    if any(r[2] == db.OUTBOX_EVENT and r[1] != db.PROCESS_ID for r in rows):
+                        outbox.wake()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("change feed poll failed")
+
+
+async def prune_changes():
+    return await booking_db.run(db.prune_changes, time.time() - CHANGES_KEEP)
@@ -72,3 +72,37 @@ def is_compatible(chosen_key: str, existing_keys: set[str]) -> bool:
         return chosen_key != "cannibal"
     else:
         return chosen_key == "cannibal"
+
+
+# ---------- правила вместимости слота ----------
+# Описание, а не код: rules.py при старте компилирует его в битовые таблицы.
+# Окно старта квеста — его last_start в QUESTS (и необязательный first_start).
+
+@dataclass(frozen=True)
+class Resource:
+    """Комната/ресурс: сколько броней из quests может идти в слоте одновременно."""
+    capacity: int
+    quests: tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class Period:
+    """Часть дня [start, end): какие квесты можно начинать и сколько броней в слоте."""
+    start: time
+    end: time | None              # None — до конца дня
+    quests: tuple[str, ...] | None  # None — все квесты
+    slot_capacity: int
+
+
+RESOURCES = {
+    # Каннибал — отдельная площадка, не больше одной команды
+    "cannibal": Resource(1, ("cannibal",)),
+    # остальные квесты делят общий зал: одновременно только один из них
+    "hall": Resource(1, ("inferno", "patient0", "hospital", "cabin")),
+}
+
+PERIODS = (
+    Period(time(0, 0), SETTINGS.NIGHT_FROM, None, 2),
+    # после 22:00 — только Каннибал и без параллелей
+    Period(SETTINGS.NIGHT_FROM, None, ("cannibal",), 1),
+)
@@ -1,14 +1,141 @@
 # db.py
+import heapq
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Callable
 
-DB_PATH = "bookings.sqlite3"
+from rules import RULES
 
+DB_PATH = os.getenv("DB_PATH", "bookings.sqlite3")
 
-def init_db():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
+# ---------- пул соединений ----------
+POOL_SIZE = max(1, int(os.getenv("DB_POOL_SIZE", "4")))
+STATEMENT_CACHE = 128
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # читатели не блокируют писателя
+    "PRAGMA synchronous=NORMAL",      # в WAL этого достаточно для надёжности
+    "PRAGMA cache_size=-8000",        # ~8 МБ кеша страниц на соединение
+    "PRAGMA mmap_size=67108864",      # 64 МБ memory-mapped I/O
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE)
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    return con
+
+
+class _Pool:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(_connect(path))
+
+    @contextmanager
+    def connection(self):
+        con = self._idle.get()
+        try:
+            yield con
+        except BaseException:
+            con.rollback()
+            raise
+        finally:
+            self._idle.put(con)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool: _Pool | None = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> _Pool:
+    global _pool
+    pool = _pool
+    if pool is not None and pool.path == DB_PATH:
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = _Pool(DB_PATH, POOL_SIZE)
+        return _pool
+
+
+def connection():
+    """Берёт соединение из пула на время with-блока."""
+    return _get_pool().connection()
+
+
+@contextmanager
+def standalone_connection():
+    """Отдельное соединение вне пула — для долгих чтений (выгрузка), чтобы не занимать пул."""
+    con = _connect(DB_PATH)
+    try:
+        yield con
+    finally:
+        con.close()
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# ---------- подписки на изменения ----------
+# Слушатели вызываются после commit, в том же потоке, что и запись:
+# fn(event, slot_iso, service_key), event: "booked" | "confirmed" | "released".
+_listeners: list[Callable[[str, str, str], None]] = []
+
+# В режиме нескольких процессов изменения ещё и пишутся в таблицу changes
+# (в той же транзакции), откуда их читают остальные процессы (cluster.py).
+CHANGE_LOG = False
+# событие журнала «в outbox появились сообщения»; подписчикам db.subscribe не передаётся
+OUTBOX_EVENT = "outbox"
+PROCESS_ID = f"{os.getpid()}-{os.urandom(3).hex()}"
+
+
+def subscribe(fn: Callable[[str, str, str], None]):
+    _listeners.append(fn)
+
+
+def _notify(event: str, slot_iso: str, service_key: str):
+    for fn in _listeners:
+        fn(event, slot_iso, service_key)
+
+
+def _log_change(con: sqlite3.Connection, event: str, slot_iso: str, service_key: str):
+    if CHANGE_LOG:
+        con.execute("""
+            INSERT INTO changes (origin, event, slot_iso, service_key, at) VALUES (?, ?, ?, ?, ?)
+        """, (PROCESS_ID, event, slot_iso, service_key, time.time()))
+
+
+# ---------- схема ----------
+# Миграции применяются по порядку; номер последней хранится в PRAGMA user_version.
+# Новые изменения схемы — только добавлением в конец списка.
+MIGRATIONS: list[tuple[str, ...]] = [
+    # 1: исходная таблица
+    ("""
     CREATE TABLE IF NOT EXISTS bookings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         created_at TEXT NOT NULL,
@@ -25,94 +152,690 @@ def init_db():
         confirmed_by_name TEXT,
         confirmed_at TEXT
     )
-    """)
-    con.commit()
-    con.close()
+    """,),
+    # 2: индексы под выборки по слоту/дате и по пользователю
+    (
+        "CREATE INDEX IF NOT EXISTS idx_bookings_slot_status ON bookings(slot_iso, status)",
+        "CREATE INDEX IF NOT EXISTS idx_bookings_user ON bookings(tg_user_id)",
+    ),
+    # 3: страховка от двойной брони на уровне БД — в слоте не больше 2 активных броней
+    # и не больше одной на квест. Триггер, а не UNIQUE-индекс, чтобы миграция
+    # не падала на старых дублях, уже лежащих в базе. Сейчас init_db заменяет его
+    # триггером из rules.RULES (sync_capacity_trigger).
+    ("""
+    CREATE TRIGGER IF NOT EXISTS trg_bookings_slot_capacity
+    BEFORE INSERT ON bookings
+    WHEN NEW.status IN ('pending','confirmed') AND (
+        SELECT COUNT(*) >= 2 OR SUM(service_key = NEW.service_key) > 0
+        FROM bookings
+        WHERE slot_iso = NEW.slot_iso AND status IN ('pending','confirmed')
+    )
+    BEGIN
+        SELECT RAISE(ABORT, 'slot taken');
+    END
+    """,),
+    # 4: исходящие сообщения (outbox): status pending -> удаляется после отправки | dead
+    ("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        reply_markup TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT
+    )
+    """,
+     "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)",
+     "CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, status, id)",
+     ),
+    # 5: состояние FSM aiogram (fsm_storage.py)
+    ("""
+    CREATE TABLE IF NOT EXISTS fsm (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+     "CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated_at)",
+     ),
+    # 6: несколько процессов — аренда лидерства и журнал изменений броней
+    ("""
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """, """
+    CREATE TABLE IF NOT EXISTS changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        origin TEXT NOT NULL,
+        event TEXT NOT NULL,
+        slot_iso TEXT NOT NULL,
+        service_key TEXT NOT NULL,
+        at REAL NOT NULL
+    )
+    """),
+    # 7: архив прошедших броней (та же схема, id сохраняются); переносит archive_past_bookings
+    ("""
+    CREATE TABLE IF NOT EXISTS bookings_archive (
+        id INTEGER PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        tg_user_id INTEGER NOT NULL,
+        tg_username TEXT,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        service_key TEXT NOT NULL,
+        service_title TEXT NOT NULL,
+        team_size INTEGER NOT NULL,
+        slot_iso TEXT NOT NULL,
+        status TEXT NOT NULL,
+        confirmed_by_id INTEGER,
+        confirmed_by_name TEXT,
+        confirmed_at TEXT
+    )
+    """,
+     "CREATE INDEX IF NOT EXISTS idx_bookings_archive_slot ON bookings_archive(slot_iso)",
+     ),
+    # 8: истечение неподтверждённых броней (expiry.py) читает только pending
+    ("CREATE INDEX IF NOT EXISTS idx_bookings_pending ON bookings(id, created_at) WHERE status='pending'",),
+    # 9: напоминания перед визитом (reminders.py): pending -> sent | skipped
+    ("""
+    CREATE TABLE IF NOT EXISTS reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        booking_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        due_at REAL NOT NULL,
+        slot_at REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        UNIQUE (booking_id, kind)
+    )
+    """,
+     "CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders(id, due_at) WHERE status='pending'",
+     ),
+]
+
+
+def schema_version(con: sqlite3.Connection) -> int:
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con: sqlite3.Connection):
+    version = schema_version(con)
+    for num, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        with con:
+            for sql in statements:
+                con.execute(sql)
+            # PRAGMA не принимает параметры
+            con.execute(f"PRAGMA user_version={num}")
+
+
+CAPACITY_TRIGGER = "trg_bookings_slot_capacity"
+
+
+def sync_capacity_trigger(con: sqlite3.Connection):
+    """
+    Триггер-страховка вместимости строится из тех же правил, что и проверка
+    в коде (rules.RULES), и пересоздаётся, если config поменялся — иначе
+    старый триггер отклонял бы разрешённые брони как SlotTaken.
+    """
+    sql = RULES.trigger_sql(CAPACITY_TRIGGER)
+    get = "SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?"
+    row = con.execute(get, (CAPACITY_TRIGGER,)).fetchone()
+    if row and row[0] == sql:
+        return
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        row = con.execute(get, (CAPACITY_TRIGGER,)).fetchone()  # другой процесс мог успеть раньше
+        if not row or row[0] != sql:
+            con.execute(f"DROP TRIGGER IF EXISTS {CAPACITY_TRIGGER}")
+            con.execute(sql)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+
+
+def init_db():
+    with connection() as con:
+        migrate(con)
+        sync_capacity_trigger(con)
+
+
+def day_bounds(date_iso: str) -> tuple[str, str]:
+    # slot_iso имеет вид YYYY-MM-DDTHH:MM, поэтому все слоты дня лежат
+    # в полуинтервале ["YYYY-MM-DDT", "YYYY-MM-DDU") — это диапазон по индексу, а не LIKE-скан
+    return date_iso + "T", date_iso + "U"
 
 
 def list_slot_services(slot_iso: str) -> set[str]:
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-        SELECT service_key
-        FROM bookings
-        WHERE slot_iso=? AND status IN ('pending','confirmed')
-    """, (slot_iso,))
-    rows = cur.fetchall()
-    con.close()
+    with connection() as con:
+        rows = con.execute("""
+            SELECT service_key
+            FROM bookings
+            WHERE slot_iso=? AND status IN ('pending','confirmed')
+        """, (slot_iso,)).fetchall()
     return {r[0] for r in rows}
 
 
+def list_active_services_for_date(date_iso: str) -> dict[str, set[str]]:
+    """Занятость всех слотов дня одним запросом: slot_iso -> {service_key}."""
+    with connection() as con:
+        rows = con.execute("""
+            SELECT slot_iso, service_key
+            FROM bookings
+            WHERE slot_iso >= ? AND slot_iso < ? AND status IN ('pending','confirmed')
+        """, day_bounds(date_iso)).fetchall()
+    out: dict[str, set[str]] = {}
+    for slot_iso, service_key in rows:
+        out.setdefault(slot_iso, set()).add(service_key)
+    return out
+
+
+def list_active_in_range(start_iso: str, end_iso: str) -> list[tuple[str, str]]:
+    """Активные брони со slot_iso в [start_iso, end_iso): (slot_iso, service_key)."""
+    with connection() as con:
+        return con.execute("""
+            SELECT slot_iso, service_key
+            FROM bookings
+            WHERE slot_iso >= ? AND slot_iso < ? AND status IN ('pending','confirmed')
+        """, (start_iso, end_iso)).fetchall()
+
+
 def create_booking(*, tg_user_id: int, tg_username: str | None, name: str, phone: str,
                    service_key: str, service_title: str, team_size: int, slot_iso: str) -> int:
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO bookings (created_at, tg_user_id, tg_username, name, phone, service_key, service_title, team_size, slot_iso, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
-    """, (
-        datetime.utcnow().isoformat(timespec="seconds"),
-        tg_user_id, tg_username, name, phone,
-        service_key, service_title, team_size, slot_iso
-    ))
-    con.commit()
-    booking_id = cur.lastrowid
-    con.close()
-    return booking_id
+    with connection() as con:
+        cur = con.execute("""
+            INSERT INTO bookings (created_at, tg_user_id, tg_username, name, phone, service_key, service_title, team_size, slot_iso, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+        """, (
+            datetime.utcnow().isoformat(timespec="seconds"),
+            tg_user_id, tg_username, name, phone,
+            service_key, service_title, team_size, slot_iso
+        ))
+        _log_change(con, "booked", slot_iso, service_key)
+        con.commit()
+    _notify("booked", slot_iso, service_key)
+    return cur.lastrowid
+
+
+@dataclass(frozen=True)
+class Reserved:
+    booking_id: int
+
+
+@dataclass(frozen=True)
+class SlotTaken:
+    slot_iso: str
+    existing: frozenset[str]
+
+
+ReserveResult = Reserved | SlotTaken
+
+
+def reserve_booking(*, tg_user_id: int, tg_username: str | None, name: str, phone: str,
+                    service_key: str, service_title: str, team_size: int, slot_iso: str,
+                    accepts: Callable[[set[str]], bool]) -> ReserveResult:
+    """
+    Проверка занятости и вставка в одной транзакции BEGIN IMMEDIATE.
+    accepts(existing) решает, можно ли поставить бронь к уже занятым квестам слота.
+    """
+    with connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            existing = {r[0] for r in con.execute("""
+                SELECT service_key
+                FROM bookings
+                WHERE slot_iso=? AND status IN ('pending','confirmed')
+            """, (slot_iso,))}
+            if not accepts(existing):
+                con.rollback()
+                return SlotTaken(slot_iso, frozenset(existing))
+            cur = con.execute("""
+                INSERT INTO bookings (created_at, tg_user_id, tg_username, name, phone, service_key, service_title, team_size, slot_iso, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+            """, (
+                datetime.utcnow().isoformat(timespec="seconds"),
+                tg_user_id, tg_username, name, phone,
+                service_key, service_title, team_size, slot_iso
+            ))
+        except sqlite3.IntegrityError:
+            # сработал триггер ёмкости слота
+            con.rollback()
+            return SlotTaken(slot_iso, frozenset(existing))
+        _log_change(con, "booked", slot_iso, service_key)
+        con.commit()
+    _notify("booked", slot_iso, service_key)
+    return Reserved(cur.lastrowid)
 
 
 def get_booking(booking_id: int):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-      SELECT id, tg_user_id, tg_username, name, phone,
-             service_key, service_title, team_size, slot_iso,
-             status, confirmed_by_id, confirmed_by_name, confirmed_at
-      FROM bookings WHERE id=?
-    """, (booking_id,))
-    row = cur.fetchone()
-    con.close()
-    return row
-
-
-def confirm_booking(booking_id: int, admin_id: int, admin_name: str) -> int:
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-        UPDATE bookings
-        SET status='confirmed', confirmed_by_id=?, confirmed_by_name=?, confirmed_at=?
-        WHERE id=? AND status='pending'
-    """, (admin_id, admin_name, datetime.utcnow().isoformat(timespec="seconds"), booking_id))
-    con.commit()
-    changed = cur.rowcount
-    con.close()
-    return changed
-
-
-def reject_booking(booking_id: int) -> int:
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-        UPDATE bookings
-        SET status='rejected'
-        WHERE id=? AND status='pending'
-    """, (booking_id,))
-    con.commit()
-    changed = cur.rowcount
-    con.close()
-    return changed
-
-
-def list_bookings_for_date(date_iso: str):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
+    with connection() as con:
+        return con.execute("""
+          SELECT id, tg_user_id, tg_username, name, phone,
+                 service_key, service_title, team_size, slot_iso,
+                 status, confirmed_by_id, confirmed_by_name, confirmed_at
+          FROM bookings WHERE id=?
+        """, (booking_id,)).fetchone()
+
+
+def confirm_booking(booking_id: int, admin_id: int, admin_name: str,
+                    reminders: Callable[[str], list[tuple[str, float, float]]] | None = None,
+                    messages: Callable[[tuple], list[tuple[str, str | None]]] | None = None) -> int:
+    """
+    reminders(slot_iso) -> [(kind, due_at, slot_at)] — напоминания, которые
+    ставятся в той же транзакции (повторное подтверждение их не задвоит).
+    messages(row) -> [(text, reply_markup_json)] — сообщения гостю, тоже в той же
+    транзакции через outbox; row = (id, tg_user_id, service_key, service_title,
+    team_size, slot_iso).
+    """
+    with connection() as con:
+        rows = con.execute("""
+            UPDATE bookings
+            SET status='confirmed', confirmed_by_id=?, confirmed_by_name=?, confirmed_at=?
+            WHERE id=? AND status='pending'
+            RETURNING id, tg_user_id, service_key, service_title, team_size, slot_iso
+        """, (admin_id, admin_name, datetime.utcnow().isoformat(timespec="seconds"), booking_id)).fetchall()
+        for row in rows:
+            _id, tg_user_id, service_key, _title, _team, slot_iso = row
+            _log_change(con, "confirmed", slot_iso, service_key)
+            if reminders is not None:
+                con.executemany("""
+                    INSERT OR IGNORE INTO reminders (booking_id, kind, chat_id, due_at, slot_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, [(booking_id, kind, tg_user_id, due_at, slot_at) for kind, due_at, slot_at in reminders(slot_iso)])
+            if messages is not None:
+                _insert_outbox(con, [(tg_user_id, text, markup) for text, markup in messages(row)], time.time())
+                _log_change(con, OUTBOX_EVENT, "", "")
+        con.commit()
+    for row in rows:
+        _notify("confirmed", row[5], row[2])
+    return len(rows)
+
+
+def reject_booking(booking_id: int, message: Callable[[tuple], str] | None = None) -> int:
+    """message(row) -> текст гостю, кладётся в outbox в той же транзакции; row как в confirm_booking."""
+    with connection() as con:
+        rows = con.execute("""
+            UPDATE bookings
+            SET status='rejected'
+            WHERE id=? AND status='pending'
+            RETURNING id, tg_user_id, service_key, service_title, team_size, slot_iso
+        """, (booking_id,)).fetchall()
+        for row in rows:
+            _log_change(con, "released", row[5], row[2])
+            if message is not None:
+                _insert_outbox(con, [(row[1], message(row), None)], time.time())
+                _log_change(con, OUTBOX_EVENT, "", "")
+        con.commit()
+    for row in rows:
+        _notify("released", row[5], row[2])
+    return len(rows)
+
+
+def list_pending_since(after_id: int = 0) -> list[tuple[int, float, str]]:
+    """[(id, created_at в unix-секундах, slot_iso)] ожидающих броней с id > after_id."""
+    with connection() as con:
+        return con.execute("""
+            SELECT id, CAST(strftime('%s', created_at) AS REAL), slot_iso
+            FROM bookings WHERE status='pending' AND id > ? ORDER BY id
+        """, (after_id,)).fetchall()
+
+
+def expire_bookings(ids: list[int], now: float, message: Callable[[tuple], str | None]) -> list[tuple]:
+    """
+    Переводит брони из pending в expired одним UPDATE; уже обработанные
+    пропускаются. В той же транзакции кладёт в outbox сообщение пользователю
+    (message(row) -> текст; None — без сообщения). Возвращает строки
+    (id, tg_user_id, service_key, service_title, slot_iso) снятых броней.
+    """
+    if not ids:
+        return []
+    marks = ",".join("?" * len(ids))
+    with connection() as con:
+        rows = con.execute(f"""
+            UPDATE bookings SET status='expired'
+            WHERE id IN ({marks}) AND status='pending'
+            RETURNING id, tg_user_id, service_key, service_title, slot_iso
+        """, ids).fetchall()
+        for _id, _uid, service_key, _title, slot_iso in rows:
+            _log_change(con, "released", slot_iso, service_key)
+        texts = [(r[1], message(r)) for r in rows]
+        _insert_outbox(con, [(uid, text, None) for uid, text in texts if text], now)
+        con.commit()
+    for _id, _uid, service_key, _title, slot_iso in rows:
+        _notify("released", slot_iso, service_key)
+    return rows
+
+
+def list_bookings_for_date(date_iso: str, *, include_archive: bool = False):
+    sql = """
         SELECT
           id, service_title, team_size, name, phone, slot_iso, status, confirmed_by_name
-        FROM bookings
-        WHERE slot_iso LIKE ?
-        ORDER BY slot_iso ASC
-    """, (date_iso + "T%",))
-    rows = cur.fetchall()
-    con.close()
+        FROM {table}
+        WHERE slot_iso >= ? AND slot_iso < ?
+    """
+    with connection() as con:
+        if not include_archive:
+            return con.execute(sql.format(table="bookings") + " ORDER BY slot_iso ASC",
+                               day_bounds(date_iso)).fetchall()
+        # прошедший день может лежать частью в архиве, частью ещё в основной таблице
+        return con.execute(
+            sql.format(table="bookings") + " UNION ALL " + sql.format(table="bookings_archive")
+            + " ORDER BY slot_iso ASC",
+            day_bounds(date_iso) * 2,
+        ).fetchall()
+
+
+def list_bookings_page(date_iso: str, *, cursor: tuple[str, int] | None = None, backward: bool = False,
+                       status: str | None = None, service_key: str | None = None, limit: int = 10):
+    """
+    Keyset-пагинация броней дня по (slot_iso, id): строки после cursor
+    (или до него при backward=True), не больше limit, всегда по возрастанию.
+    """
+    where = ["slot_iso >= ?", "slot_iso < ?"]
+    params: list = list(day_bounds(date_iso))
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if service_key:
+        where.append("service_key = ?")
+        params.append(service_key)
+    if cursor:
+        where.append("(slot_iso, id) < (?, ?)" if backward else "(slot_iso, id) > (?, ?)")
+        params.extend(cursor)
+    order = "DESC" if backward else "ASC"
+    params.append(limit)
+    with connection() as con:
+        rows = con.execute(f"""
+            SELECT
+              id, service_title, team_size, name, phone, slot_iso, status, confirmed_by_name
+            FROM bookings
+            WHERE {" AND ".join(where)}
+            ORDER BY slot_iso {order}, id {order}
+            LIMIT ?
+        """, params).fetchall()
+    if backward:
+        rows.reverse()
     return rows
+
+
+EXPORT_COLUMNS = (
+    "id", "created_at", "slot_iso", "status", "service_key", "service_title", "team_size",
+    "name", "phone", "tg_user_id", "tg_username", "confirmed_by_name", "confirmed_at",
+)
+
+
+def _iter_table_range(con: sqlite3.Connection, table: str, start_iso: str, end_iso: str, batch: int):
+    cur = con.execute(f"""
+        SELECT {", ".join(EXPORT_COLUMNS)}
+        FROM {table}
+        WHERE slot_iso >= ? AND slot_iso < ?
+        ORDER BY slot_iso, id
+    """, (start_iso, end_iso))
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            break
+        yield from rows
+
+
+def iter_bookings_range(start_iso: str, end_iso: str, batch: int = 1000, *,
+                        include_archive: bool = False, standalone: bool = False):
+    """
+    Брони со slot_iso в [start_iso, end_iso) по порядку, пачками по batch строк.
+    include_archive=True добавляет архив: два упорядоченных курсора сливаются
+    на лету, без сортировки всего диапазона в памяти.
+    Генератор держит соединение, пока его не дочитают — вызывать в одном потоке;
+    standalone=True берёт своё соединение вместо соединения пула.
+    """
+    with standalone_connection() if standalone else connection() as con:
+        hot = _iter_table_range(con, "bookings", start_iso, end_iso, batch)
+        if not include_archive:
+            yield from hot
+            return
+        cold = _iter_table_range(con, "bookings_archive", start_iso, end_iso, batch)
+        yield from heapq.merge(hot, cold, key=_export_order)
+
+
+def _export_order(row) -> tuple[str, int]:
+    return row[2], row[0]   # slot_iso, id
+
+
+# ---------- архив ----------
+BOOKING_COLUMNS = (
+    "id", "created_at", "tg_user_id", "tg_username", "name", "phone", "service_key",
+    "service_title", "team_size", "slot_iso", "status", "confirmed_by_id", "confirmed_by_name",
+    "confirmed_at",
+)
+
+
+def archive_past_bookings(before_iso: str, batch: int = 500) -> int:
+    """
+    Переносит в bookings_archive до batch броней со slot_iso < before_iso.
+    Одна короткая транзакция на пачку, чтобы не держать блокировку записи;
+    вызывать повторно, пока не вернёт 0.
+    """
+    with connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        ids = [r[0] for r in con.execute(
+            "SELECT id FROM bookings WHERE slot_iso < ? ORDER BY slot_iso LIMIT ?",
+            (before_iso, batch),
+        )]
+        if not ids:
+            con.rollback()
+            return 0
+        marks = ",".join("?" * len(ids))
+        con.execute(f"""
+            INSERT OR REPLACE INTO bookings_archive ({", ".join(BOOKING_COLUMNS)})
+            SELECT {", ".join(BOOKING_COLUMNS)} FROM bookings WHERE id IN ({marks})
+        """, ids)
+        con.execute(f"DELETE FROM bookings WHERE id IN ({marks})", ids)
+        con.commit()
+        return len(ids)
+
+
+def archive_stats() -> dict:
+    with connection() as con:
+        hot, hot_min = con.execute("SELECT COUNT(*), MIN(slot_iso) FROM bookings").fetchone()
+        cold, cold_max = con.execute("SELECT COUNT(*), MAX(slot_iso) FROM bookings_archive").fetchone()
+    return {"hot": hot, "hot_oldest": hot_min, "archived": cold, "archived_newest": cold_max}
+
+
+# ---------- напоминания ----------
+def list_pending_reminders(after_id: int = 0) -> list[tuple[int, float]]:
+    with connection() as con:
+        return con.execute(
+            "SELECT id, due_at FROM reminders WHERE status='pending' AND id > ? ORDER BY id", (after_id,),
+        ).fetchall()
+
+
+def send_reminders(ids: list[int], now: float, message: Callable[[tuple], str]) -> tuple[int, int]:
+    """
+    Забирает pending-напоминания ids одной транзакцией: актуальные кладёт
+    в outbox (message(row) -> текст, row = (id, kind, chat_id, service_title,
+    slot_iso)) и помечает sent, остальные — skipped. Пропускаются напоминания,
+    если бронь уже не confirmed, слот начался или у той же брони подошло
+    более позднее напоминание (после простоя шлём только его).
+    Возвращает (отправлено, пропущено).
+    """
+    if not ids:
+        return 0, 0
+    marks = ",".join("?" * len(ids))
+    with connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        rows = con.execute(f"""
+            SELECT r.id, r.kind, r.chat_id, b.service_title, b.slot_iso,
+                   b.status = 'confirmed' AND r.slot_at > ? AND NOT EXISTS (
+                       SELECT 1 FROM reminders l
+                       WHERE l.booking_id = r.booking_id AND l.status = 'pending'
+                         AND l.due_at > r.due_at AND l.due_at <= ?
+                   )
+            FROM reminders r LEFT JOIN bookings b ON b.id = r.booking_id
+            WHERE r.id IN ({marks}) AND r.status = 'pending'
+        """, (now, now, *ids)).fetchall()
+        send = [r[:5] for r in rows if r[5]]
+        skip = [r[0] for r in rows if not r[5]]
+        _insert_outbox(con, [(r[2], message(r), None) for r in send], now)
+        con.executemany("UPDATE reminders SET status='sent' WHERE id=?", [(r[0],) for r in send])
+        con.executemany("UPDATE reminders SET status='skipped' WHERE id=?", [(i,) for i in skip])
+        con.commit()
+    return len(send), len(skip)
+
+
+def reminder_stats() -> dict:
+    with connection() as con:
+        counts = dict(con.execute("SELECT status, COUNT(*) FROM reminders GROUP BY status").fetchall())
+        nxt = con.execute("SELECT MIN(due_at) FROM reminders WHERE status='pending'").fetchone()[0]
+    return {"pending": counts.get("pending", 0), "sent": counts.get("sent", 0),
+            "skipped": counts.get("skipped", 0), "next_due_at": nxt}
+
+
+# ---------- outbox ----------
+def enqueue_messages(messages: list[tuple[int, str, str | None]], now: float) -> list[int]:
+    """Кладёт (chat_id, text, reply_markup_json) в outbox одной транзакцией."""
+    with connection() as con:
+        ids = _insert_outbox(con, messages, now)
+        _log_change(con, OUTBOX_EVENT, "", "")
+        con.commit()
+    return ids
+
+
+def _insert_outbox(con: sqlite3.Connection, messages: list[tuple[int, str, str | None]], now: float) -> list[int]:
+    created = datetime.utcnow().isoformat(timespec="seconds")
+    ids = []
+    for chat_id, text, markup in messages:
+        cur = con.execute("""
+            INSERT INTO outbox (created_at, chat_id, text, reply_markup, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (created, chat_id, text, markup, now))
+        ids.append(cur.lastrowid)
+    return ids
+
+
+def dequeue_outbox(now: float, limit: int):
+    """
+    Готовые к отправке сообщения, не больше одного на чат: берём только самое раннее
+    pending-сообщение чата, чтобы сохранить порядок внутри чата.
+    """
+    with connection() as con:
+        return con.execute("""
+            SELECT o.id, o.chat_id, o.text, o.reply_markup, o.attempts
+            FROM outbox o
+            WHERE o.status='pending' AND o.next_attempt_at <= ?
+              AND o.id = (SELECT MIN(id) FROM outbox WHERE chat_id=o.chat_id AND status='pending')
+            ORDER BY o.id
+            LIMIT ?
+        """, (now, limit)).fetchall()
+
+
+def next_outbox_attempt_at() -> float | None:
+    """Ближайший срок среди тех же сообщений, что берёт dequeue_outbox (первое pending чата)."""
+    with connection() as con:
+        return con.execute("""
+            SELECT MIN(o.next_attempt_at) FROM outbox o
+            WHERE o.status='pending'
+              AND o.id = (SELECT MIN(id) FROM outbox WHERE chat_id=o.chat_id AND status='pending')
+        """).fetchone()[0]
+
+
+def mark_outbox_sent(ids: list[int]):
+    if not ids:
+        return
+    with connection() as con:
+        con.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in ids])
+        con.commit()
+
+
+def mark_outbox_failed(outbox_id: int, error: str, next_attempt_at: float, dead: bool):
+    with connection() as con:
+        con.execute("""
+            UPDATE outbox
+            SET attempts=attempts+1, last_error=?, next_attempt_at=?, status=?
+            WHERE id=?
+        """, (error, next_attempt_at, "dead" if dead else "pending", outbox_id))
+        con.commit()
+
+
+def outbox_stats(now: float, dead_limit: int = 5) -> dict:
+    with connection() as con:
+        counts = dict(con.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        oldest = con.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status='pending'").fetchone()[0]
+        dead = con.execute("""
+            SELECT id, chat_id, attempts, last_error FROM outbox
+            WHERE status='dead' ORDER BY id DESC LIMIT ?
+        """, (dead_limit,)).fetchall()
+    return {
+        "pending": counts.get("pending", 0),
+        "dead": counts.get("dead", 0),
+        "oldest_due_age": max(0.0, now - oldest) if oldest is not None else 0.0,
+        "recent_dead": dead,
+    }
+
+
+# ---------- FSM ----------
+def fsm_load(key: str) -> tuple[str | None, str, float] | None:
+    with connection() as con:
+        return con.execute("SELECT state, data, updated_at FROM fsm WHERE key=?", (key,)).fetchone()
+
+
+def fsm_flush(upserts: list[tuple[str, str | None, str, float]], deletes: list[str]):
+    """Пачка изменений FSM одной транзакцией: upserts — (key, state, data_json, updated_at)."""
+    with connection() as con:
+        con.executemany("""
+            INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+        """, upserts)
+        con.executemany("DELETE FROM fsm WHERE key=?", [(k,) for k in deletes])
+        con.commit()
+
+
+def fsm_purge(before: float) -> int:
+    with connection() as con:
+        cur = con.execute("DELETE FROM fsm WHERE updated_at < ?", (before,))
+        con.commit()
+        return cur.rowcount
+
+
+# ---------- несколько процессов ----------
+def acquire_lease(name: str, owner: str, ttl: float, now: float) -> bool:
+    """Берёт или продлевает аренду; True, если owner — текущий владелец."""
+    with connection() as con:
+        con.execute("""
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE leases.owner=excluded.owner OR leases.expires_at < ?
+        """, (name, owner, now + ttl, now))
+        con.commit()
+        row = con.execute("SELECT owner FROM leases WHERE name=?", (name,)).fetchone()
+    return row is not None and row[0] == owner
+
+
+def release_lease(name: str, owner: str):
+    with connection() as con:
+        con.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, owner))
+        con.commit()
+
+
+def last_change_seq() -> int:
+    with connection() as con:
+        return con.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+
+def changes_since(seq: int, limit: int = 500) -> list[tuple[int, str, str, str, str]]:
+    with connection() as con:
+        return con.execute("""
+            SELECT seq, origin, event, slot_iso, service_key
+            FROM changes WHERE seq > ? ORDER BY seq LIMIT ?
+        """, (seq, limit)).fetchall()
+
+
+def prune_changes(before: float) -> int:
+    with connection() as con:
+        cur = con.execute("DELETE FROM changes WHERE at < ?", (before,))
+        con.commit()
+        return cur.rowcount
@@ -0,0 +1,127 @@
+# db_async.py
+"""
+Асинхронные обёртки над db.py для aiogram-хендлеров.
+
+Все запросы выполняются в ограниченном пуле потоков, чтобы медленный диск
+не блокировал event loop вебхука. Сигнатуры совпадают с db.py, только их нужно await-ить.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+import tracing
+from db import Reserved, SlotTaken, ReserveResult  # noqa: F401  (реэкспорт для хендлеров)
+
+# не больше потоков, чем соединений в пуле — иначе потоки будут ждать друг друга
+DB_WORKERS = max(1, int(os.getenv("DB_WORKERS", str(db.POOL_SIZE))))
+
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+def _timed(fn, queued_at: float, trace, args, kwargs):
+    # в потоке пула: ожидание свободного потока и само время вызова db.py
+    t0 = time.perf_counter()
+    metrics.DB_WAIT.observe(t0 - queued_at)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        t1 = time.perf_counter()
+        name = getattr(fn, "__name__", "call")
+        metrics.DB_LATENCY.observe(t1 - t0, name)
+        tracing.db_call(name, trace, t0, t1)
+
+
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # контекст (трассировка) в поток пула не переходит — передаём явно
+    return await loop.run_in_executor(_executor, _timed, fn, time.perf_counter(), tracing.current(), args, kwargs)
+
+
+async def init_db():
+    return await run(db.init_db)
+
+
+async def list_slot_services(slot_iso: str) -> set[str]:
+    return await run(db.list_slot_services, slot_iso)
+
+
+async def list_active_in_range(start_iso: str, end_iso: str) -> list[tuple[str, str]]:
+    return await run(db.list_active_in_range, start_iso, end_iso)
+
+
+async def list_active_services_for_date(date_iso: str) -> dict[str, set[str]]:
+    return await run(db.list_active_services_for_date, date_iso)
+
+
+async def create_booking(*, tg_user_id: int, tg_username: str | None, name: str, phone: str,
+                         service_key: str, service_title: str, team_size: int, slot_iso: str) -> int:
+    return await run(
+        db.create_booking,
+        tg_user_id=tg_user_id, tg_username=tg_username, name=name, phone=phone,
+        service_key=service_key, service_title=service_title, team_size=team_size, slot_iso=slot_iso,
+    )
+
+
+async def reserve_booking(*, tg_user_id: int, tg_username: str | None, name: str, phone: str,
+                          service_key: str, service_title: str, team_size: int, slot_iso: str,
+                          accepts) -> db.ReserveResult:
+    return await run(
+        db.reserve_booking,
+        tg_user_id=tg_user_id, tg_username=tg_username, name=name, phone=phone,
+        service_key=service_key, service_title=service_title, team_size=team_size, slot_iso=slot_iso,
+        accepts=accepts,
+    )
+
+
+async def get_booking(booking_id: int):
+    return await run(db.get_booking, booking_id)
+
+
+async def confirm_booking(booking_id: int, admin_id: int, admin_name: str, reminders=None, messages=None) -> int:
+    return await run(db.confirm_booking, booking_id, admin_id, admin_name, reminders, messages)
+
+
+async def reject_booking(booking_id: int, message=None) -> int:
+    return await run(db.reject_booking, booking_id, message)
+
+
+async def list_bookings_for_date(date_iso: str, *, include_archive: bool = False):
+    return await run(db.list_bookings_for_date, date_iso, include_archive=include_archive)
+
+
+async def list_bookings_page(date_iso: str, *, cursor: tuple[str, int] | None = None, backward: bool = False,
+                             status: str | None = None, service_key: str | None = None, limit: int = 10):
+    return await run(db.list_bookings_page, date_iso, cursor=cursor, backward=backward,
+                     status=status, service_key=service_key, limit=limit)
+
+
+async def enqueue_messages(messages: list[tuple[int, str, str | None]], now: float) -> list[int]:
+    return await run(db.enqueue_messages, messages, now)
+
+
+async def dequeue_outbox(now: float, limit: int):
+    return await run(db.dequeue_outbox, now, limit)
+
+
+async def next_outbox_attempt_at() -> float | None:
+    return await run(db.next_outbox_attempt_at)
+
+
+async def mark_outbox_sent(ids: list[int]):
+    return await run(db.mark_outbox_sent, ids)
+
+
+async def mark_outbox_failed(outbox_id: int, error: str, next_attempt_at: float, dead: bool):
+    return await run(db.mark_outbox_failed, outbox_id, error, next_attempt_at, dead)
+
+
+async def outbox_stats(now: float) -> dict:
+    return await run(db.outbox_stats, now)
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+    db.close_pool()
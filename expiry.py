@@ -0,0 +1,70 @@
+# expiry.py
+"""
+Истечение неподтверждённых броней.
+
+Бронь в pending занимает слот, пока админ не ответит. Если ответа нет
+PENDING_TTL_MINUTES, бронь переходит в expired и пользователь получает
+сообщение через outbox. Сроки держит scheduler.Scheduler: при старте
+загружаются все pending из БД, дальше по событию "booked" (db.subscribe,
+в т.ч. от других процессов) догружаются только новые id. Снятие — пачкой
+в одном UPDATE с событием "released", так что индекс занятости и кеши
+клавиатур обновляются как при отклонении. Брони, чей слот уже прошёл,
+снимаются сразу и без сообщения пользователю.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import time
+from datetime import datetime
+
+import db
+import db_async as booking_db
+import metrics
+import outbox
+from booking_logic import parse_slot_iso, tz
+from scheduler import DbTimers
+
+log = logging.getLogger(__name__)
+
+PENDING_TTL = float(os.getenv("PENDING_TTL_MINUTES", "120")) * 60
+EXPIRE_BATCH = 200
+
+
+def expired_text(row) -> str | None:
+    _id, _uid, _key, service_title, slot_iso = row
+    slot_dt = parse_slot_iso(slot_iso)
+    if slot_dt.timestamp() <= time.time():
+        return None  # слот уже прошёл — снимаем молча
+    return (f"Бронь на {slot_dt.strftime('%d.%m.%Y %H:%M')} («{service_title}») не успели подтвердить, "
+            f"и она снята.\nСоздайте бронь заново: /start")
+
+
+class PendingExpiry(DbTimers):
+    def __init__(self, ttl: float = PENDING_TTL, clock=time.time, batch: int = EXPIRE_BATCH):
+        super().__init__(self._pending, "booked", self._expire, clock=clock, batch=batch)
+        self.ttl = ttl
+        self.expired = 0
+
+    async def _pending(self, after_id: int) -> list[tuple[int, float]]:
+        rows = await booking_db.run(db.list_pending_since, after_id)
+        now = self.clock()
+        # slot_iso — местное "YYYY-MM-DDTHH:MM", поэтому сравниваем строки
+        cutoff = datetime.fromtimestamp(now, tz()).strftime("%Y-%m-%dT%H:%M")
+        # слот уже прошёл (старые брони) — снимаем сразу и без сообщения (expired_text)
+        return [(booking_id, now if slot_iso <= cutoff else created_at + self.ttl)
+                for booking_id, created_at, slot_iso in rows]
+
+    async def _expire(self, ids: list[int]):
+        rows = await booking_db.run(db.expire_bookings, ids, time.time(), expired_text)
+        if not rows:
+            return
+        self.expired += len(rows)
+        for r in rows:
+            metrics.BOOKINGS.inc("expired", r[2])
+        outbox.wake()
+        log.info("expired %s pending bookings", len(rows))
+
+
+EXPIRY = PendingExpiry()
+db.subscribe(EXPIRY.on_change)
@@ -0,0 +1,88 @@
+# export.py
+"""
+Выгрузка броней за произвольный период в CSV.gz (или XLSX, если установлен openpyxl).
+
+Строки идут из БД генератором прямо в файл на диске, поэтому память
+не растёт с числом строк. Прошедшие брони из архива входят в выгрузку.
+Вызывается в отдельном потоке (asyncio.to_thread), не в пуле db_async.
+"""
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+from datetime import date, timedelta
+
+import db
+from booking_logic import calc_price, parse_slot_iso
+
+COLUMNS = (*db.EXPORT_COLUMNS, "price")
+SERVICE_KEY_COL = db.EXPORT_COLUMNS.index("service_key")
+TEAM_COL = db.EXPORT_COLUMNS.index("team_size")
+SLOT_COL = db.EXPORT_COLUMNS.index("slot_iso")
+
+
+def parse_period(args: list[str]) -> tuple[date, date]:
+    """
+    ГГГГ | ГГГГ-ММ | ГГГГ-ММ-ДД [ГГГГ-ММ-ДД] -> [начало, конец) по датам.
+    """
+    if not args or len(args) > 2:
+        raise ValueError("period")
+    if len(args) == 2:
+        start, end = date.fromisoformat(args[0]), date.fromisoformat(args[1])
+        if end < start:
+            raise ValueError("period")
+        return start, end + timedelta(days=1)
+    p = args[0]
+    if len(p) == 4:
+        y = int(p)
+        return date(y, 1, 1), date(y + 1, 1, 1)
+    if len(p) == 7:
+        y, m = (int(x) for x in p.split("-"))
+        start = date(y, m, 1)
+        return start, date(y + (m == 12), m % 12 + 1, 1)
+    d = date.fromisoformat(p)
+    return d, d + timedelta(days=1)
+
+
+def export_rows(start: date, end: date):
+    # выгрузка может идти минутами — на своём соединении, пул остаётся хендлерам
+    for row in db.iter_bookings_range(start.isoformat(), end.isoformat(), include_archive=True, standalone=True):
+        try:
+            price = calc_price(row[SERVICE_KEY_COL], row[TEAM_COL], parse_slot_iso(row[SLOT_COL]))
+        except (KeyError, ValueError):
+            price = None  # старые записи с неизвестным квестом/форматом
+        yield (*row, price)
+
+
+def write_csv_gz(start: date, end: date, path: str) -> int:
+    n = 0
+    with gzip.open(path, "wb") as gz, io.TextIOWrapper(gz, encoding="utf-8-sig", newline="") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow(COLUMNS)
+        for row in export_rows(start, end):
+            w.writerow(row)
+            n += 1
+    return n
+
+
+def write_xlsx(start: date, end: date, path: str) -> int:
+    from openpyxl import Workbook  # необязательная зависимость
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("bookings")
+    ws.append(COLUMNS)
+    n = 0
+    for row in export_rows(start, end):
+        ws.append(row)
+        n += 1
+    wb.save(path)
+    return n
+
+
+def xlsx_available() -> bool:
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
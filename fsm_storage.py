@@ -0,0 +1,155 @@
+# fsm_storage.py
+"""
+FSM-хранилище aiogram поверх bookings.sqlite3.
+
+Чтения обслуживаются из кеша в памяти; записи (частые update_data в
+choose_service/choose_team/choose_date) копятся в кеше и сбрасываются в БД
+пачкой раз в FLUSH_INTERVAL — несколько изменений одного ключа дают одну запись.
+Брошенные сценарии старше TTL удаляются периодической чисткой.
+
+shared=True — для нескольких процессов: без кеша и с немедленной записью,
+чтобы апдейты одного чата, попавшие в разные процессы, видели одно состояние.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import db_async as booking_db
+import db
+
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5
+TTL = 24 * 3600
+CLEANUP_INTERVAL = 3600
+
+
+def key_str(key: StorageKey) -> str:
+    return ":".join(str(p) for p in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id,
+        getattr(key, "business_connection_id", None), key.destiny,
+    ))
+
+
+class _Entry:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state: str | None, data: dict[str, Any], updated_at: float):
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, ttl: float = TTL,
+                 cleanup_interval: float = CLEANUP_INTERVAL, shared: bool = False):
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._cache: dict[str, _Entry] = {}
+        self._dirty: set[str] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    # ---------- кеш ----------
+    async def _entry(self, key: StorageKey) -> _Entry:
+        k = key_str(key)
+        e = None if self.shared else self._cache.get(k)
+        if e is None:
+            row = await booking_db.run(db.fsm_load, k)
+            e = _Entry(row[0], json.loads(row[1]), row[2]) if row else _Entry(None, {}, time.time())
+            if not self.shared:
+                # пока ждали БД, ключ могли записать — кеш важнее
+                e = self._cache.setdefault(k, e)
+        return e
+
+    async def _touch(self, key: StorageKey, e: _Entry):
+        e.updated_at = time.time()
+        k = key_str(key)
+        self._dirty.add(k)
+        if self.shared:
+            self._cache[k] = e
+            await self.flush()
+        if not self._tasks:
+            # задачи живут дольше апдейта: без его контекста (трассировки)
+            self._tasks = [
+                asyncio.create_task(self._flush_loop(), context=contextvars.Context()),
+                asyncio.create_task(self._cleanup_loop(), context=contextvars.Context()),
+            ]
+
+    # ---------- BaseStorage ----------
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        e = await self._entry(key)
+        e.state = state.state if isinstance(state, State) else state
+        await self._touch(key, e)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        e = await self._entry(key)
+        e.data = dict(data)
+        await self._touch(key, e)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._entry(key)).data)
+
+    async def close(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+        await self.flush()
+
+    # ---------- write-behind ----------
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for k in keys:
+            e = self._cache.get(k)
+            if e is None or (e.state is None and not e.data):
+                deletes.append(k)
+            else:
+                upserts.append((k, e.state, json.dumps(e.data, ensure_ascii=False), e.updated_at))
+        try:
+            await booking_db.run(db.fsm_flush, upserts, deletes)
+        except Exception:
+            # вернём ключи, чтобы записать в следующий раз
+            self._dirty |= keys
+            raise
+        if self.shared:
+            for k in keys:
+                self._cache.pop(k, None)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("fsm flush failed")
+
+    async def cleanup(self) -> int:
+        before = time.time() - self.ttl
+        for k in [k for k, e in self._cache.items() if e.updated_at < before and k not in self._dirty]:
+            del self._cache[k]
+        return await booking_db.run(db.fsm_purge, before)
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await self.cleanup()
+                if removed:
+                    log.info("fsm cleanup removed %s abandoned flows", removed)
+            except Exception:
+                log.exception("fsm cleanup failed")
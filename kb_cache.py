@@ -0,0 +1,60 @@
+# kb_cache.py
+"""
+Кеш клавиатур, зависящих от занятости слотов.
+
+Ключ — (date_iso, *доп. ключ), например (дата, service_key) для выбора времени.
+Любое изменение брони за дату (db.subscribe, в т.ч. пришедшее от других
+процессов через cluster.ChangeFeed) сбрасывает все записи этой даты.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Any, Hashable
+
+import db
+
+
+class DateKeyedCache:
+    def __init__(self):
+        self._data: dict[str, dict[Hashable, Any]] = {}
+        self._versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, date_iso: str) -> int:
+        """Снимается до чтения занятости: put с устаревшей версией ничего не запишет."""
+        return self._versions.get(date_iso, 0)
+
+    def get(self, date_iso: str, key: Hashable) -> Any | None:
+        value = self._data.get(date_iso, {}).get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, date_iso: str, key: Hashable, value: Any, version: int):
+        with self._lock:
+            if self._versions.get(date_iso, 0) == version:
+                self._data.setdefault(date_iso, {})[key] = value
+
+    def invalidate_date(self, date_iso: str):
+        with self._lock:
+            self._versions[date_iso] = self._versions.get(date_iso, 0) + 1
+            self._data.pop(date_iso, None)
+
+    def drop_before(self, date_iso: str):
+        with self._lock:
+            for d in [d for d in self._data if d < date_iso]:
+                del self._data[d]
+            for d in [d for d in self._versions if d < date_iso]:
+                del self._versions[d]
+
+    def on_change(self, event: str, slot_iso: str, service_key: str):
+        if event != "confirmed":  # подтверждение не меняет занятость
+            self.invalidate_date(slot_iso[:10])
+
+
+TIMES_KB = DateKeyedCache()
+db.subscribe(TIMES_KB.on_change)
@@ -0,0 +1,191 @@
+# metrics.py
+"""
+Метрики в текстовом формате Prometheus (GET /metrics), без внешних зависимостей.
+
+Счётчики и гистограммы живут в памяти процесса; при нескольких воркерах
+uvicorn каждый процесс отдаёт свои значения. Запись — словарь и bisect под
+локом, порядка микросекунды на наблюдение.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(v)
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, v in items:
+            out.append(f"{self.name}{_labels(self.labelnames, labels)} {_num(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счётчики по корзинам (последняя — +Inf), сумма, количество]
+        self._series: dict[tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, seconds: float, *labels: str):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += seconds
+            s[2] += 1
+
+    def count(self, *labels: str) -> int:
+        s = self._series.get(labels)
+        return s[2] if s else 0
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        for labels, (counts, total, n) in items:
+            acc = 0
+            for bound, c in zip((*self.buckets, "+Inf"), counts):
+                acc += c
+                le = 'le="%s"' % ("+Inf" if bound == "+Inf" else _num(bound))
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total!r}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {n}")
+        return out
+
+
+REGISTRY: list[Counter | Histogram] = []
+
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency.", ("path", "status"))
+HANDLER_LATENCY = Histogram("handler_duration_seconds", "aiogram handler latency.", ("handler",))
+HANDLER_ERRORS = Counter("handler_errors_total", "Exceptions raised by aiogram handlers.", ("handler",))
+DB_LATENCY = Histogram("db_call_duration_seconds", "Time spent in db.py calls.", ("fn",))
+DB_WAIT = Histogram("db_wait_seconds", "Time a db call waited for a free DB worker thread.")
+API_LATENCY = Histogram("telegram_api_duration_seconds", "Bot API request latency.", ("method",))
+API_ERRORS = Counter("telegram_api_errors_total", "Failed Bot API requests.", ("method", "error"))
+BOOKINGS = Counter("bookings_total", "Booking state changes.", ("event", "service"))
+REMINDERS = Counter("reminders_total", "Pre-visit reminders taken from the schedule.", ("outcome",))
+
+
+def render() -> str:
+    lines: list[str] = []
+    for m in REGISTRY:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- HTTP ----------
+class ASGIMetrics:
+    """
+    ASGI-обёртка приложения: латентность по пути и коду ответа.
+    paths — известные пути и их метки (секретный путь вебхука в метки не попадает).
+    """
+
+    def __init__(self, app, paths: dict[str, str]):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_LATENCY.observe(time.perf_counter() - t0, self.paths.get(scope["path"], "other"), status)
+
+
+# ---------- aiogram ----------
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: вызывается только для найденного хендлера."""
+
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: dict[str, Any]) -> Any:
+        name = data["handler"].callback.__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - t0, name)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: латентность и ошибки каждого запроса к Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - t0, name)
+
+
+def instrument_dispatcher(dp):
+    mw = HandlerMetricsMiddleware()
+    dp.message.middleware(mw)
+    dp.callback_query.middleware(mw)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(RequestMetricsMiddleware())
@@ -0,0 +1,121 @@
+# notify.py
+"""
+Рассылка сообщений с учётом лимитов Telegram.
+
+Глобальный token bucket (~30 сообщений/с на бота) и интервал между сообщениями
+в один чат (~1/с). TelegramRetryAfter ждём столько, сколько сказал Telegram,
+сетевые ошибки повторяем с экспоненциальной паузой, остальные — не повторяем.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Iterable
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = float(burst)
+        self._last = clock()
+
+    async def acquire(self):
+        # токен резервируется сразу, поэтому порядок ожидающих сохраняется
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class ChatPacer:
+    """Не чаще одного сообщения в interval секунд на чат."""
+
+    def __init__(self, interval: float, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._next: dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        now = self.clock()
+        if len(self._next) > 10_000:
+            self._next = {c: t for c, t in self._next.items() if t > now}
+        at = max(now, self._next.get(chat_id, now))
+        self._next[chat_id] = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def sent(self, chat_id: int):
+        """
+        Отсчёт интервала — от фактической отправки: после acquire запрос ещё
+        ждёт token bucket, и без этого следующий запрос в чат (повтор) мог
+        уйти раньше interval.
+        """
+        self._next[chat_id] = max(self._next.get(chat_id, 0.0), self.clock() + self.interval)
+
+
+@dataclass(frozen=True)
+class Outcome:
+    chat_id: int
+    ok: bool
+    attempts: int
+    error: str | None = None
+    retry_after: float | None = None
+    retryable: bool = False
+
+
+class Notifier:
+    def __init__(self, rate: float = 30.0, burst: int = 30, per_chat_interval: float = 1.0,
+                 max_attempts: int = 4, base_backoff: float = 0.5):
+        self.bucket = TokenBucket(rate, burst)
+        self.pacer = ChatPacer(per_chat_interval)
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+
+    async def send(self, bot: Bot, chat_id: int, text: str, *, max_attempts: int | None = None,
+                   **kwargs) -> Outcome:
+        max_attempts = max_attempts or self.max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.pacer.acquire(chat_id)
+            await self.bucket.acquire()
+            self.pacer.sent(chat_id)
+            try:
+                await bot.send_message(chat_id, text, **kwargs)
+                return Outcome(chat_id, True, attempt)
+            except TelegramRetryAfter as e:
+                if attempt >= max_attempts:
+                    return Outcome(chat_id, False, attempt, f"retry_after={e.retry_after}", e.retry_after, True)
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= max_attempts:
+                    return Outcome(chat_id, False, attempt, repr(e), retryable=True)
+                await asyncio.sleep(self.base_backoff * 2 ** (attempt - 1))
+            except Exception as e:
+                # заблокировал бота, неверный chat_id и т.п. — повтор не поможет
+                return Outcome(chat_id, False, attempt, repr(e))
+
+    async def broadcast(self, bot: Bot, chat_ids: Iterable[int], text: str, **kwargs) -> list[Outcome]:
+        outcomes = await asyncio.gather(*(self.send(bot, cid, text, **kwargs) for cid in chat_ids))
+        for o in outcomes:
+            if not o.ok:
+                log.warning("send to %s failed after %s attempt(s): %s", o.chat_id, o.attempts, o.error)
+        return list(outcomes)
+
+
+NOTIFIER = Notifier()
+
+
+async def notify_admins(bot: Bot, admin_ids: Iterable[int], text: str, **kwargs) -> list[Outcome]:
+    return await NOTIFIER.broadcast(bot, admin_ids, text, **kwargs)
@@ -0,0 +1,124 @@
+# occupancy.py
+"""
+Индекс занятости слотов в памяти на весь горизонт бронирования.
+
+Для каждого slot_iso хранится битовая маска активных квестов (бит на ключ из QUESTS).
+Индекс загружается из БД при старте, обновляется write-through из db.py
+(через db.subscribe) и сдвигается в полночь по SETTINGS.TZ.
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import db
+from config import SETTINGS
+from rules import MASK_SERVICES, SERVICE_BITS, mask_of
+
+
+class OccupancyIndex:
+    def __init__(self):
+        self._masks: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.start: date | None = None
+        self.end: date | None = None  # не включительно
+
+    def covers(self, d: date) -> bool:
+        return self.start is not None and self.start <= d < self.end
+
+    def load(self, today: date, days: int = SETTINGS.DAYS_AHEAD):
+        start, end = today, today + timedelta(days=days + 1)
+        with self._lock:
+            rows = db.list_active_in_range(start.isoformat(), end.isoformat())
+            masks: dict[str, int] = {}
+            for slot_iso, service_key in rows:
+                masks[slot_iso] = masks.get(slot_iso, 0) | SERVICE_BITS.get(service_key, 0)
+            self._masks = masks
+            self.start, self.end = start, end
+
+    def roll(self, today: date, days: int = SETTINGS.DAYS_AHEAD):
+        """Сдвигает горизонт: прошедшие дни выкидываем, новые догружаем из БД."""
+        if self.start is None or today >= self.end:
+            self.load(today, days)
+            return
+        new_end = today + timedelta(days=days + 1)
+        with self._lock:
+            rows = db.list_active_in_range(self.end.isoformat(), new_end.isoformat()) if new_end > self.end else []
+            cut = today.isoformat()
+            masks = {k: m for k, m in self._masks.items() if k >= cut}
+            for slot_iso, service_key in rows:
+                masks[slot_iso] = masks.get(slot_iso, 0) | SERVICE_BITS.get(service_key, 0)
+            self._masks = masks
+            self.start, self.end = today, new_end
+
+    # ---------- чтение ----------
+    def mask(self, slot_iso: str) -> int:
+        return self._masks.get(slot_iso, 0)
+
+    def services(self, slot_iso: str) -> frozenset[str]:
+        return MASK_SERVICES[self._masks.get(slot_iso, 0)]
+
+    def day(self, d: date) -> dict[str, set[str]]:
+        prefix = d.isoformat()
+        return {k: set(MASK_SERVICES[m]) for k, m in self._masks.items() if m and k.startswith(prefix)}
+
+    # ---------- write-through ----------
+    def on_change(self, event: str, slot_iso: str, service_key: str):
+        d = date.fromisoformat(slot_iso[:10])
+        if not self.covers(d):
+            return
+        if event == "booked":
+            with self._lock:
+                self._masks[slot_iso] = self._masks.get(slot_iso, 0) | SERVICE_BITS.get(service_key, 0)
+        elif event == "released":
+            # перечитываем слот целиком: в старых данных на один квест могло быть несколько броней
+            self.refresh_slot(slot_iso)
+
+    def refresh_slot(self, slot_iso: str):
+        with self._lock:
+            m = mask_of(db.list_slot_services(slot_iso))
+            if m:
+                self._masks[slot_iso] = m
+            else:
+                self._masks.pop(slot_iso, None)
+
+    # ---------- сверка ----------
+    def verify(self) -> list[tuple[str, frozenset[str], frozenset[str]]]:
+        """Сверка с БД: [(slot_iso, в памяти, в БД)] для расходящихся слотов."""
+        if self.start is None:
+            return []
+        with self._lock:
+            actual: dict[str, int] = {}
+            for slot_iso, service_key in db.list_active_in_range(self.start.isoformat(), self.end.isoformat()):
+                actual[slot_iso] = actual.get(slot_iso, 0) | SERVICE_BITS.get(service_key, 0)
+            mine = {k: m for k, m in self._masks.items() if m}
+        diff = []
+        for slot_iso in sorted(set(actual) | set(mine)):
+            a, b = mine.get(slot_iso, 0), actual.get(slot_iso, 0)
+            if a != b:
+                diff.append((slot_iso, MASK_SERVICES[a], MASK_SERVICES[b]))
+        return diff
+
+
+INDEX = OccupancyIndex()
+db.subscribe(INDEX.on_change)
+
+
+def local_today() -> date:
+    return datetime.now(ZoneInfo(SETTINGS.TZ)).date()
+
+
+async def start(run):
+    """Загрузка при старте; run — исполнитель блокирующих вызовов (db_async.run)."""
+    await run(INDEX.load, local_today())
+
+
+async def midnight_roll_loop(run):
+    Z = ZoneInfo(SETTINGS.TZ)
+    while True:
+        now = datetime.now(Z)
+        nxt = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=Z)
+        await asyncio.sleep(max(1.0, (nxt - now).total_seconds()))
+        await run(INDEX.roll, local_today())
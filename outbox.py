@@ -0,0 +1,122 @@
+# outbox.py
+"""
+Надёжная отправка сообщений пользователям через таблицу outbox.
+
+Хендлеры только кладут сообщения в очередь (enqueue) и сразу отвечают.
+Фоновый воркер забирает пачки готовых сообщений (по одному на чат, чтобы
+не нарушать порядок), шлёт их через notify.NOTIFIER, повторяет с
+экспоненциальной паузой и после MAX_ATTEMPTS переводит в dead.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+
+import db_async as booking_db
+from notify import NOTIFIER, Notifier
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 20
+MAX_ATTEMPTS = 8
+BASE_BACKOFF = 2.0
+MAX_BACKOFF = 600.0
+IDLE_POLL = 30.0
+
+_wakeup: asyncio.Event | None = None
+
+
+def _event() -> asyncio.Event:
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+
+def wake():
+    _event().set()
+
+
+def pack(*messages: str | tuple[str, InlineKeyboardMarkup | None]) -> list[tuple[str, str | None]]:
+    """Текст или (текст, inline-клавиатура) -> (текст, reply_markup JSON) для таблицы outbox."""
+    out = []
+    for m in messages:
+        text, markup = (m, None) if isinstance(m, str) else m
+        out.append((text, markup.model_dump_json(exclude_none=True) if markup else None))
+    return out
+
+
+async def enqueue(chat_id: int, *messages: str | tuple[str, InlineKeyboardMarkup | None]) -> list[int]:
+    """
+    Ставит сообщения в очередь одной транзакцией; порядок сохраняется.
+    Элемент — текст или (текст, inline-клавиатура).
+    """
+    rows = [(chat_id, text, markup) for text, markup in pack(*messages)]
+    ids = await booking_db.enqueue_messages(rows, time.time())
+    wake()
+    return ids
+
+
+def backoff(attempts: int, retry_after: float | None = None) -> float:
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempts)
+    return max(delay, retry_after or 0.0)
+
+
+class OutboxWorker:
+    def __init__(self, bot: Bot, notifier: Notifier = NOTIFIER, batch_size: int = BATCH_SIZE):
+        self.bot = bot
+        self.notifier = notifier
+        self.batch_size = batch_size
+
+    async def _deliver(self, row) -> tuple[int, bool]:
+        outbox_id, chat_id, text, markup_json, attempts = row
+        kwargs = {}
+        if markup_json:
+            kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate_json(markup_json)
+        # повторы делает сам outbox, поэтому одна попытка за проход
+        outcome = await self.notifier.send(self.bot, chat_id, text, max_attempts=1, **kwargs)
+        if outcome.ok:
+            return outbox_id, True
+        dead = not outcome.retryable or attempts + 1 >= MAX_ATTEMPTS
+        if dead:
+            log.warning("outbox #%s to %s is dead: %s", outbox_id, chat_id, outcome.error)
+        await booking_db.mark_outbox_failed(
+            outbox_id, outcome.error or "", time.time() + backoff(attempts, outcome.retry_after), dead,
+        )
+        return outbox_id, False
+
+    async def run_once(self) -> int:
+        rows = await booking_db.dequeue_outbox(time.time(), self.batch_size)
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(self._deliver(r) for r in rows))
+        await booking_db.mark_outbox_sent([i for i, ok in results if ok])
+        return len(rows)
+
+    async def run(self):
+        wakeup = _event()
+        while True:
+            # сбрасываем до выборки: enqueue во время прохода не потеряется
+            wakeup.clear()
+            try:
+                if await self.run_once():
+                    continue
+                nxt = await booking_db.next_outbox_attempt_at()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("outbox worker iteration failed")
+                nxt = None
+            timeout = IDLE_POLL if nxt is None else min(IDLE_POLL, max(0.0, nxt - time.time()))
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def stats() -> dict:
+    return await booking_db.outbox_stats(time.time())
@@ -0,0 +1,70 @@
+# reminders.py
+"""
+Напоминания перед визитом (по умолчанию за 24 и за 2 часа).
+
+При подтверждении брони напоминания пишутся в таблицу reminders в той же
+транзакции (plan). Сроки держит scheduler.Scheduler: при старте лидера
+загружаются все pending, дальше по событию "confirmed" догружаются новые id.
+Подошедшие напоминания забираются пачками по REMIND_BATCH: в одной
+транзакции сообщение кладётся в outbox и напоминание помечается sent,
+поэтому после перезапуска повторов нет. Скорость отправки ограничивает
+outbox (notify.Notifier).
+"""
+from __future__ import annotations
+
+import os
+import time
+
+import db
+import db_async as booking_db
+import metrics
+import outbox
+from booking_logic import parse_slot_iso
+from config import SETTINGS
+from scheduler import DbTimers
+
+REMINDER_HOURS = tuple(int(h) for h in os.getenv("REMINDER_HOURS", "24,2").split(",") if h.strip())
+REMIND_BATCH = 50
+REMIND_PAUSE = 0.5
+
+
+def plan(slot_iso: str, now: float | None = None, hours: tuple[int, ...] = REMINDER_HOURS) -> list[tuple[str, float, float]]:
+    """[(kind, due_at, slot_at)] для ещё не наступивших напоминаний."""
+    now = time.time() if now is None else now
+    slot_at = parse_slot_iso(slot_iso).timestamp()
+    return [(f"{h}h", slot_at - h * 3600, slot_at) for h in hours if slot_at - h * 3600 > now]
+
+
+def reminder_text(row) -> str:
+    _id, kind, _chat_id, service_title, slot_iso = row
+    slot_dt = parse_slot_iso(slot_iso)
+    when = "завтра" if kind == "24h" else f"через {kind[:-1]} ч"
+    return (f"Напоминаем: {when}, {slot_dt.strftime('%d.%m.%Y в %H:%M')}, ждём вас на квесте «{service_title}».\n"
+            f"Адрес: {SETTINGS.ADDRESS}\n{SETTINGS.PAYMENT}")
+
+
+class ReminderService(DbTimers):
+    def __init__(self, clock=time.time, batch: int = REMIND_BATCH, pause: float = REMIND_PAUSE):
+        super().__init__(self._pending, "confirmed", self._send, clock=clock, batch=batch, pause=pause)
+        self.sent = 0
+        self.skipped = 0
+
+    async def _pending(self, after_id: int) -> list[tuple[int, float]]:
+        return await booking_db.run(db.list_pending_reminders, after_id)
+
+    async def _send(self, ids: list[int]):
+        sent, skipped = await booking_db.run(db.send_reminders, ids, self.clock(), reminder_text)
+        self.sent += sent
+        self.skipped += skipped
+        metrics.REMINDERS.inc("sent", amount=sent)
+        metrics.REMINDERS.inc("skipped", amount=skipped)
+        if sent:
+            outbox.wake()
+
+
+REMINDERS = ReminderService()
+db.subscribe(REMINDERS.on_change)
+
+
+async def stats() -> dict:
+    return await booking_db.run(db.reminder_stats)
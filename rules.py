@@ -0,0 +1,176 @@
+# rules.py
+"""
+Правила вместимости слота, скомпилированные в битовые таблицы.
+
+Описание правил — в config.py (RESOURCES, PERIODS, окна старта в QUESTS).
+Для каждого времени начала считается класс: квесты, разрешённые по времени,
+и таблица «маска занятых квестов -> маска квестов, которые ещё можно поставить».
+Проверка слота — поиск класса по времени, индекс в таблице и AND с битом квеста.
+"""
+from __future__ import annotations
+
+from datetime import time
+
+from config import PERIODS, QUESTS, RESOURCES, SETTINGS, Period, Resource, is_compatible
+
+# бит на квест; маски занятости в индексе (occupancy.py) и в таблицах правил — одни и те же
+SERVICE_BITS: dict[str, int] = {key: 1 << i for i, key in enumerate(QUESTS)}
+
+# маска -> множество ключей; квестов немного, поэтому таблица на все маски
+MASK_SERVICES: tuple[frozenset[str], ...] = tuple(
+    frozenset(k for k, bit in SERVICE_BITS.items() if mask & bit)
+    for mask in range(1 << len(SERVICE_BITS))
+)
+
+
+def mask_of(keys) -> int:
+    m = 0
+    for k in keys:
+        m |= SERVICE_BITS.get(k, 0)
+    return m
+
+
+class CompiledRules:
+    def __init__(self, quests: dict, resources: dict[str, Resource], periods: tuple[Period, ...],
+                 bits: dict[str, int] = SERVICE_BITS):
+        unknown = {q for r in resources.values() for q in r.quests} - set(quests)
+        unknown |= {q for p in periods for q in (p.quests or ())} - set(quests)
+        if unknown:
+            raise ValueError(f"unknown quests in rules: {sorted(unknown)}")
+        self.quests = quests
+        self.periods = periods
+        self.bits = bits
+        self.masks = 1 << len(bits)
+        # (маска квестов ресурса, вместимость)
+        self.resources = tuple((mask_of(r.quests), r.capacity) for r in resources.values())
+        self.time_masks: list[int] = []          # класс -> квесты, разрешённые по времени
+        self.tables: list[tuple[int, ...]] = []  # класс -> [маска занятых] -> кого ещё можно поставить
+        # класс на каждую минуту суток; всё считается здесь, дальше только чтение (и из потоков БД)
+        classes: dict[tuple[int, int], int] = {}
+        by_minute = []
+        for m in range(24 * 60):
+            t = time(m // 60, m % 60)
+            period = self._period(t)
+            key = (self._time_mask(t, period), period.slot_capacity if period else 0)
+            if key not in classes:
+                classes[key] = len(self.tables)
+                self.time_masks.append(key[0])
+                self.tables.append(self._table(*key))
+            by_minute.append(classes[key])
+        self._class_by_minute = tuple(by_minute)
+        self._table_by_minute = tuple(self.tables[c] for c in by_minute)
+
+    def _period(self, t: time) -> Period | None:
+        for p in self.periods:
+            if p.start <= t and (p.end is None or t < p.end):
+                return p
+        return None
+
+    def _time_mask(self, t: time, period: Period | None) -> int:
+        if period is None:
+            return 0
+        mask = 0
+        for key, bit in self.bits.items():
+            q = self.quests[key]
+            if t > q["last_start"] or t < q.get("first_start", time(0, 0)):
+                continue
+            if period.quests is not None and key not in period.quests:
+                continue
+            mask |= bit
+        return mask
+
+    def _table(self, time_mask: int, capacity: int) -> tuple[int, ...]:
+        table = []
+        for occupied in range(self.masks):
+            free = 0
+            if occupied.bit_count() < capacity:
+                for bit in self.bits.values():
+                    if not time_mask & bit or occupied & bit:
+                        continue
+                    if all((occupied & rmask).bit_count() < cap
+                           for rmask, cap in self.resources if rmask & bit):
+                        free |= bit
+            table.append(free)
+        return tuple(table)
+
+    def time_class(self, t: time) -> int:
+        return self._class_by_minute[t.hour * 60 + t.minute]
+
+    def time_allows(self, service_key: str, t: time) -> bool:
+        return bool(self.time_masks[self.time_class(t)] & self.bits[service_key])
+
+    def table(self, t: time) -> tuple[int, ...]:
+        """[маска занятых] -> маска квестов, которые ещё можно поставить в слот со временем t."""
+        return self._table_by_minute[t.hour * 60 + t.minute]
+
+    def accepts(self, service_key: str, t: time, occupied: int) -> bool:
+        return bool(self._table_by_minute[t.hour * 60 + t.minute][occupied] & self.bits[service_key])
+
+    # ---------- страховка в БД ----------
+    def _sql_keys(self, mask: int) -> str:
+        return "(" + ", ".join(f"'{k}'" for k, bit in self.bits.items() if mask & bit) + ")"
+
+    def trigger_sql(self, name: str) -> str:
+        """
+        BEFORE INSERT-триггер с теми же ограничениями вместимости (без окон
+        старта квестов): не больше одной брони на квест, вместимость слота
+        по времени начала (periods) и вместимость ресурсов. db.init_db
+        пересоздаёт триггер, если правила в config поменялись.
+        """
+        hhmm = "substr(NEW.slot_iso, 12, 5)"
+        cases = []
+        for p in self.periods:
+            cond = f"{hhmm} >= '{p.start:%H:%M}'" + (f" AND {hhmm} < '{p.end:%H:%M}'" if p.end else "")
+            cases.append(f"WHEN {cond} THEN {p.slot_capacity}")
+        checks = [
+            "SUM(service_key = NEW.service_key) > 0",
+            f"COUNT(*) >= CASE {' '.join(cases)} ELSE 0 END",
+        ]
+        for rmask, cap in self.resources:
+            keys = self._sql_keys(rmask)
+            checks.append(f"(NEW.service_key IN {keys} AND SUM(service_key IN {keys}) >= {cap})")
+        where = "\n        OR ".join(checks)
+        return f"""CREATE TRIGGER {name}
+    BEFORE INSERT ON bookings
+    WHEN NEW.status IN ('pending','confirmed') AND (
+        SELECT {where}
+        FROM bookings
+        WHERE slot_iso = NEW.slot_iso AND status IN ('pending','confirmed')
+    )
+    BEGIN
+        SELECT RAISE(ABORT, 'slot taken');
+    END"""
+
+
+RULES = CompiledRules(QUESTS, RESOURCES, PERIODS)
+
+
+# ---------- сверка с прежними правилами ----------
+def legacy_accepts(service_key: str, t: time, existing: set[str]) -> bool:
+    """Проверка слота в том виде, как она была зашита в booking_logic/config до RULES."""
+    if t > QUESTS[service_key]["last_start"]:
+        return False
+    if t >= SETTINGS.NIGHT_FROM:
+        return service_key == "cannibal" and len(existing) == 0
+    return is_compatible(service_key, existing)
+
+
+def verify_against_legacy(rules: CompiledRules = RULES, minutes_step: int = 5) -> dict:
+    """
+    Перебор всех времён дня с шагом minutes_step, всех квестов и всех масок
+    занятости: скомпилированные правила должны совпадать с legacy_accepts.
+    """
+    checked = 0
+    mismatches = []
+    for m in range(0, 24 * 60, minutes_step):
+        t = time(m // 60, m % 60)
+        for occupied in range(rules.masks):
+            existing = set(MASK_SERVICES[occupied])
+            for key in QUESTS:
+                checked += 1
+                got = rules.accepts(key, t, occupied)
+                want = legacy_accepts(key, t, existing)
+                if got != want:
+                    mismatches.append((t.strftime("%H:%M"), key, sorted(existing), got, want))
+    return {"checked": checked, "classes": len(rules.tables), "mismatches": mismatches}
+
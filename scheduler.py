@@ -0,0 +1,160 @@
+# scheduler.py
+"""
+Таймеры на мин-куче: одна задача спит до ближайшего срока, а не опрашивает БД.
+
+Ключ — любой hashable (id брони и т.п.); повторный add переносит срок,
+cancel снимает таймер. Устаревшие записи кучи не удаляются сразу, а
+пропускаются при извлечении. Часы передаются снаружи (clock), поэтому
+due(now) можно гонять с подставным временем. DbTimers — общая обвязка
+для сроков из БД (истечение броней, напоминания).
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import time
+from itertools import count
+from typing import Awaitable, Callable, Hashable
+
+log = logging.getLogger(__name__)
+
+MAX_SLEEP = 3600.0
+RETRY_PAUSE = 5.0
+
+
+class Scheduler:
+    def __init__(self, handler: Callable[[list], Awaitable[None]], *, clock: Callable[[], float] = time.time,
+                 batch: int = 200, pause: float = 0.0):
+        self.handler = handler
+        self.clock = clock
+        self.batch = batch
+        self.pause = pause  # между подряд идущими пачками
+        self._heap: list[tuple[float, int, Hashable]] = []
+        self._when: dict[Hashable, float] = {}
+        self._seq = count()  # при равных сроках — порядок добавления, ключи не сравниваются
+        self._wakeup: asyncio.Event | None = None
+
+    def __len__(self) -> int:
+        return len(self._when)
+
+    def add(self, key: Hashable, when: float):
+        self._when[key] = when
+        heapq.heappush(self._heap, (when, next(self._seq), key))
+        if self._heap[0][2] == key and self._wakeup is not None:
+            self._wakeup.set()  # новый ближайший срок — спим меньше
+
+    def cancel(self, key: Hashable):
+        self._when.pop(key, None)
+
+    def next_at(self) -> float | None:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and self._when.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def due(self, now: float, limit: int | None = None) -> list:
+        """Снимает с кучи до limit ключей со сроком <= now, по возрастанию срока."""
+        limit = limit or self.batch
+        out = []
+        heap = self._heap
+        while heap and len(out) < limit:
+            when, _, key = heap[0]
+            if when > now:
+                break
+            heapq.heappop(heap)
+            if self._when.get(key) == when:
+                del self._when[key]
+                out.append(key)
+        return out
+
+    async def run_once(self, now: float | None = None) -> int:
+        keys = self.due(self.clock() if now is None else now)
+        if keys:
+            try:
+                await self.handler(keys)
+            except Exception:
+                # не потеряли: вернём в кучу и повторим позже
+                retry = self.clock() + RETRY_PAUSE
+                for key in keys:
+                    if key not in self._when:
+                        self.add(key, retry)
+                raise
+        return len(keys)
+
+    async def run(self):
+        self._wakeup = wakeup = asyncio.Event()
+        try:
+            while True:
+                wakeup.clear()
+                try:
+                    if await self.run_once():
+                        if self.pause:
+                            await asyncio.sleep(self.pause)
+                        continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("scheduler handler failed")
+                nxt = self.next_at()
+                timeout = MAX_SLEEP if nxt is None else min(MAX_SLEEP, max(0.0, nxt - self.clock()))
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = None
+
+
+class DbTimers:
+    """
+    Сроки, которые живут в БД: loader(after_id) -> [(id, when)] грузит записи
+    с id > last_id, дальше по событию trigger (db.subscribe) догружаются только
+    новые. Подошедшие id уходят в handler пачками через Scheduler.
+    """
+
+    def __init__(self, loader: Callable[[int], Awaitable[list]], trigger: str,
+                 handler: Callable[[list], Awaitable[None]], *, clock: Callable[[], float] = time.time,
+                 batch: int = 200, pause: float = 0.0):
+        self.loader = loader
+        self.trigger = trigger
+        self.clock = clock
+        self.scheduler = Scheduler(handler, clock=clock, batch=batch, pause=pause)
+        self.last_id = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._new: asyncio.Event | None = None
+
+    async def load(self) -> int:
+        rows = await self.loader(self.last_id)
+        for key, when in rows:
+            self.scheduler.add(key, when)
+            self.last_id = max(self.last_id, key)
+        return len(rows)
+
+    def on_change(self, event: str, slot_iso: str, service_key: str):
+        # из потока БД; новые записи читаем из базы уже в event loop
+        if event == self.trigger and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._new.set)
+
+    async def _follow(self):
+        while True:
+            await self._new.wait()
+            self._new.clear()
+            try:
+                await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("loading timers after %r failed", self.trigger)
+
+    async def run(self):
+        self._new = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        try:
+            await self.load()
+            await asyncio.gather(self.scheduler.run(), self._follow())
+        finally:
+            self._loop = None
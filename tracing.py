@@ -0,0 +1,175 @@
+# tracing.py
+"""
+Трассировка апдейтов: у апдейта trace id и список замеров (spans) — разбор
+Update, ожидание в очереди, хендлер, каждый вызов db.py и каждый запрос к Bot API.
+
+Включается переменной TRACE_SAMPLE (доля апдейтов, 0 — выключено). Решение
+о выборке принимается один раз на апдейт; невыбранные апдейты не собирают
+замеры, для них проверяется только общий порог. Апдейт дольше
+TRACE_SLOW_UPDATE_MS и вызов db.py дольше TRACE_SLOW_QUERY_MS пишутся
+в лог одной JSON-строкой (для выбранных апдейтов — со всеми замерами).
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+log = logging.getLogger("trace")
+
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0"))
+SLOW_UPDATE = float(os.getenv("TRACE_SLOW_UPDATE_MS", "1000")) / 1000
+SLOW_QUERY = float(os.getenv("TRACE_SLOW_QUERY_MS", "250")) / 1000
+
+
+class Trace:
+    __slots__ = ("trace_id", "update_id", "t0", "spans")
+
+    def __init__(self, update_id: int | None = None):
+        self.trace_id = secrets.token_hex(8)
+        self.update_id = update_id
+        self.t0 = time.perf_counter()
+        self.spans: list[tuple[str, str, float, float]] = []
+
+    def add(self, kind: str, name: str, start: float, end: float):
+        # список пополняется и из потоков пула БД — append под GIL атомарен
+        self.spans.append((kind, name, round((start - self.t0) * 1000, 3), round((end - start) * 1000, 3)))
+
+    def as_dict(self) -> dict:
+        spans = sorted(self.spans, key=lambda s: s[2])
+        return {
+            "trace_id": self.trace_id,
+            "update_id": self.update_id,
+            "spans": [{"kind": k, "name": n, "at_ms": a, "ms": d} for k, n, a, d in spans],
+        }
+
+
+# None — решение о выборке ещё не принято; False — апдейт не выбран
+_current: ContextVar[Trace | bool | None] = ContextVar("trace", default=None)
+
+
+def begin(update_id: int | None = None) -> Trace | None:
+    trace = Trace(update_id) if TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE else None
+    _current.set(trace or False)
+    return trace
+
+
+def current() -> Trace | None:
+    return _current.get() or None
+
+
+def state() -> Trace | bool | None:
+    """Состояние для передачи в другую задачу (очередь апдейтов)."""
+    return _current.get()
+
+
+def activate(value: Trace | bool | None):
+    _current.set(value)
+
+
+@contextmanager
+def span(kind: str, name: str):
+    trace = _current.get()
+    if not trace:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(kind, name, start, time.perf_counter())
+
+
+def _emit(level: int, record: dict):
+    log.log(level, json.dumps(record, ensure_ascii=False))
+
+
+def finish(value: Trace | bool | None, elapsed: float, update_id: int | None = None):
+    trace = value or None
+    slow = elapsed >= SLOW_UPDATE
+    if not slow and (trace is None or not log.isEnabledFor(logging.DEBUG)):
+        return
+    record: dict[str, Any] = {"event": "slow_update" if slow else "update", "ms": round(elapsed * 1000, 3)}
+    if trace is not None:
+        if trace.update_id is None:
+            trace.update_id = update_id
+        record.update(trace.as_dict())
+    else:
+        record["update_id"] = update_id
+    _emit(logging.WARNING if slow else logging.DEBUG, record)
+
+
+def db_call(fn_name: str, trace: Trace | None, start: float, end: float):
+    """Вызывается из потока пула БД после каждого вызова db.py."""
+    if trace is not None:
+        trace.add("db", fn_name, start, end)
+    if end - start >= SLOW_QUERY:
+        _emit(logging.WARNING, {
+            "event": "slow_query", "fn": fn_name, "ms": round((end - start) * 1000, 3),
+            "trace_id": trace.trace_id if trace else None,
+        })
+
+
+# ---------- aiogram ----------
+class UpdateTracingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware dp.update. Если апдейт пришёл без решения о выборке
+    (polling), начинает и завершает трассировку сам; вебхук и очередь
+    апдейтов делают это снаружи, чтобы учесть разбор Update и ожидание в очереди.
+    """
+
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: dict[str, Any]) -> Any:
+        if _current.get() is not None:
+            return await handler(event, data)
+        value = begin(event.update_id)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            finish(value, time.perf_counter() - t0, event.update_id)
+
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[Any, dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: dict[str, Any]) -> Any:
+        trace = _current.get()
+        if not trace:
+            return await handler(event, data)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            trace.add("handler", data["handler"].callback.__name__, start, time.perf_counter())
+
+
+class RequestTracingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        trace = _current.get()
+        if not trace:
+            return await make_request(bot, method)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            trace.add("api", type(method).__name__, start, time.perf_counter())
+
+
+def instrument_dispatcher(dp):
+    dp.update.outer_middleware(UpdateTracingMiddleware())
+    mw = HandlerTracingMiddleware()
+    dp.message.middleware(mw)
+    dp.callback_query.middleware(mw)
+
+
+def instrument_bot(bot):
+    bot.session.middleware(RequestTracingMiddleware())
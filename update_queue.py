@@ -0,0 +1,109 @@
+# update_queue.py
+"""
+Быстрый ответ вебхуку: апдейт кладётся в ограниченную очередь, обработка — в фоне.
+
+Очередь разбита на шарды по чату: все апдейты одного чата попадают к одному
+воркеру и обрабатываются строго по порядку (шаги FSM не перемешиваются),
+разные чаты обрабатываются параллельно. Если шард переполнен, submit
+возвращает False — вебхук отвечает 503 и Telegram повторит доставку позже.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import tracing
+
+log = logging.getLogger(__name__)
+
+
+def chat_key(update: Update) -> int:
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = 4, maxsize: int = 1000):
+        self.dp = dp
+        self.bot = bot
+        per_shard = max(1, maxsize // workers)
+        self._shards: list[asyncio.Queue[tuple[float, Update, object]]] = [
+            asyncio.Queue(maxsize=per_shard) for _ in range(workers)
+        ]
+        self._tasks: list[asyncio.Task] = []
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def submit(self, update: Update) -> bool:
+        shard = self._shards[chat_key(update) % len(self._shards)]
+        try:
+            # состояние трассировки вебхука едет вместе с апдейтом
+            shard.put_nowait((time.monotonic(), update, tracing.state()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def _worker(self, shard: asyncio.Queue[tuple[float, Update, object]]):
+        while True:
+            enqueued_at, update, trace = await shard.get()
+            started = time.monotonic()
+            lag = started - enqueued_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            tracing.activate(trace)
+            if trace:
+                now = time.perf_counter()
+                trace.add("queue", "wait", now - lag, now)
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                self.failed += 1
+                log.exception("update %s failed", update.update_id)
+            finally:
+                self.processed += 1
+                if trace is not None:
+                    tracing.finish(trace, time.monotonic() - enqueued_at, update.update_id)
+                tracing.activate(None)
+                shard.task_done()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._shards]
+
+    async def stop(self, drain_timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._shards)), drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning("update queue not drained, %s updates left", self.depth())
+        for t in self._tasks:
+            t.cancel()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._shards)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "shard_depths": [q.qsize() for q in self._shards],
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
@@ -0,0 +1,160 @@
+# web.py
+"""
+Webhook-режим (prod): FastAPI-приложение, вебхук и фоновые задачи процесса.
+
+Импортируется только в prod (python bot.py с MODE=prod или uvicorn web:app),
+поэтому локальный polling не тянет FastAPI и uvicorn.
+"""
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.types import Update
+from fastapi import FastAPI, Request, HTTPException, Response
+
+import db_async as booking_db
+import archive
+import cluster
+import expiry
+import metrics
+import occupancy
+import outbox
+import reminders
+import tracing
+from bot import (
+    BOT_TOKEN, MODE, MULTI_PROCESS, UPDATE_QUEUE_SIZE, UPDATE_WORKERS, WEBHOOK_ASYNC, WEBHOOK_PATH, WEBHOOK_URL,
+    build_dispatcher,
+)
+from update_queue import UpdateQueue
+
+app = FastAPI()
+app.add_middleware(metrics.ASGIMetrics, paths={
+    WEBHOOK_PATH: "webhook", "/": "/", "/metrics": "/metrics", "/queue": "/queue",
+})
+
+# глобальные bot/dp (для webhook режима)
+bot = Bot(token=BOT_TOKEN)
+metrics.instrument_bot(bot)
+tracing.instrument_bot(bot)
+dp = build_dispatcher()
+update_queue = UpdateQueue(dp, bot, UPDATE_WORKERS, UPDATE_QUEUE_SIZE) if WEBHOOK_ASYNC else None
+
+
+@app.get("/")
+def root():
+    return {"status": "ok"}
+
+
+# ВАЖНО: Render/прокси иногда делает HEAD / как health-check
+# Если не обработать — будет 405 и Render может перезапускать сервис.
+@app.head("/")
+def root_head():
+    return Response(status_code=200)
+
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    t0 = time.perf_counter()
+    trace = tracing.begin()
+    try:
+        with tracing.span("parse", "Update.model_validate"):
+            data = await request.json()
+            update = Update.model_validate(data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid update")
+
+    if update_queue is not None:
+        if not update_queue.submit(update):
+            # очередь переполнена — Telegram повторит доставку позже
+            raise HTTPException(status_code=503, detail="Overloaded")
+        return {"ok": True}
+
+    try:
+        await dp.feed_update(bot, update)
+    finally:
+        tracing.finish(trace, time.perf_counter() - t0, update.update_id)
+    return {"ok": True}
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/queue")
+def queue_stats():
+    if update_queue is None:
+        return {"mode": "inline"}
+    return {"mode": "async", **update_queue.stats()}
+
+
+async def _prune_changes_loop():
+    while True:
+        await asyncio.sleep(600)
+        await cluster.prune_changes()
+
+
+async def ensure_webhook() -> bool:
+    """
+    Ставит вебхук, только если Telegram знает другой адрес: после засыпания
+    на Render это один запрос вместо delete_webhook + set_webhook. Ожидающие
+    апдейты не сбрасываются — среди них тот, что разбудил сервис.
+    """
+    info = await bot.get_webhook_info()
+    if info.url == WEBHOOK_URL:
+        return False
+    await bot.set_webhook(WEBHOOK_URL)
+    return True
+
+
+async def _become_leader():
+    # В prod работаем через webhook (Render). В local webhook не нужен.
+    if MODE != "local":
+        if not WEBHOOK_URL.startswith("https://"):
+            raise RuntimeError("WEBHOOK_URL должен начинаться с https://")
+        await ensure_webhook()
+    app.state.leader_tasks = [
+        asyncio.create_task(outbox.OutboxWorker(bot).run()),
+        asyncio.create_task(archive.archive_loop()),
+        asyncio.create_task(expiry.EXPIRY.run()),
+        asyncio.create_task(reminders.REMINDERS.run()),
+    ]
+    if MULTI_PROCESS:
+        app.state.leader_tasks.append(asyncio.create_task(_prune_changes_loop()))
+
+
+async def _stop_leading():
+    for t in getattr(app.state, "leader_tasks", []):
+        t.cancel()
+    app.state.leader_tasks = []
+
+
+@app.on_event("startup")
+async def on_startup():
+    await booking_db.init_db()
+    background = []
+    if MULTI_PROCESS:
+        # журнал читаем с текущей позиции до загрузки индекса — ничего не пропустим
+        feed = cluster.ChangeFeed()
+        await feed.start()
+        background.append(asyncio.create_task(feed.run()))
+    await occupancy.start(booking_db.run)
+    background.append(asyncio.create_task(occupancy.midnight_roll_loop(booking_db.run)))
+    if update_queue is not None:
+        update_queue.start()
+    app.state.leader = cluster.LeaderLease("leader", _become_leader, _stop_leading)
+    background.append(asyncio.create_task(app.state.leader.run()))
+    app.state.background = background
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if update_queue is not None:
+        await update_queue.stop()
+    await dp.storage.close()
+    for t in app.state.background:
+        t.cancel()
+    # вебхук не снимаем: Render усыпляет сервис через SIGTERM, и только
+    # оставшийся вебхук разбудит его следующим апдейтом
+    await app.state.leader.release()
+    booking_db.shutdown()